@@ -1,17 +1,32 @@
 import numpy as np
 import cv2
-from face_detector import FaceDetector
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from face_detector import FaceDetector, crop_face
+from metrics import METRICS
 from os import walk
 
 
 # wrapper for a utility that returns the apparent age of a still face image
 class AgePredictor:
-    def __init__(self):
+    # fast_detection selects the fast mode of the face detector, see FaceDetector
+    # analyzer, if given, is a FaceAnalyzer that locates faces instead of the face detector, it also finds the
+    # landmarks of every face, which are added to the cache along with the age
+    def __init__(self, batch_size=32, fast_detection=False, analyzer=None):
         # age model
         # model structure: https://data.vision.ee.ethz.ch/cvl/rrothe/imdb-wiki/static/age.prototxt
         # pre-trained weights: https://data.vision.ee.ethz.ch/cvl/rrothe/imdb-wiki/static/dex_chalearn_iccv2015.caffemodel
         self.age_model = cv2.dnn.readNetFromCaffe("data/age.prototxt", "data/dex_chalearn_iccv2015.caffemodel")
-        self.fd = FaceDetector()
+        METRICS.inc("models_loaded_total", model="age")
+        self.analyzer = analyzer
+        self.fd = FaceDetector(fast=fast_detection) if analyzer is None else None
+        # maximum number of faces that go through the age model in a single forward pass
+        self.batch_size = batch_size
+        self.output_indexes = np.arange(0, 101)
+        self.lock = threading.Lock()
 
     # given an image
     # extract roi using face detector and predict the age using the age model
@@ -20,18 +35,143 @@ class AgePredictor:
     ## roi is the region of the image that contains the face
     ## angle is the rotation angle (in CCW) for the roi
     def predict_age(self, img):
-        # extract roi and resize it to the desired dimensions for the age model
-        roi, angle = self.fd.detect_face(img)
-        if roi is None:
-            return -1, None, 0
-        roi_resized = cv2.resize(roi, (224, 224))
-        img_blob = cv2.dnn.blobFromImage(roi_resized)
-        # run it through the model and return predicted age
-        self.age_model.setInput(img_blob)
-        age_dist = self.age_model.forward()[0]
-        output_indexes = np.array([i for i in range(0, 101)])
-        apparent_age = round(np.sum(age_dist * output_indexes), 2)
-        return apparent_age, roi, angle
+        return self.predict_ages([img])[0]
+
+    # batched version of predict_age
+    # given a list of images, return a list of (apparent_age, roi, angle) tuples in the same order
+    # faces that weren't found get (-1, None, 0), same as predict_age
+    # all ROIs found are run through the age model batch_size at a time
+    # if an AnalysisCache and the cache keys of the images are given, images with a cached age skip
+    # face detection and the age model entirely (such images may be None, then their roi is None),
+    # and the results for all other images are added to the cache (images whose key is None bypass the cache)
+    # with an analyzer, images whose landmarks are cached (e.g. from an earlier alignment) aren't searched for a face
+    # if an AgeInferenceService is given, the ROIs are run through the age model by the service instead,
+    # batched together with the ROIs of other threads
+    # entries, if given, are the cache entries of the images, already looked up by the caller
+    def predict_ages(self, images, cache=None, keys=None, service=None, entries=None):
+        results = [(-1, None, 0)] * len(images)
+        found = [] # indexes into images for which a face ROI was found
+        blobs = [] # resized ROIs, parallel to found
+        boxes = [None] * len(images)
+        analyses = [{}] * len(images) # other fields to cache for each image, i.e. the landmarks found by the analyzer
+        for i, img in enumerate(images):
+            use_cache = cache is not None and keys[i] is not None
+            if entries is not None:
+                entry = entries[i]
+            else:
+                entry = cache.get(keys[i]) if use_cache else {}
+            if "age" in entry:
+                roi = None
+                if img is not None and entry["box"] is not None:
+                    roi = crop_face(img, entry["box"], entry["angle"])
+                results[i] = (entry["age"], roi, entry["angle"])
+                continue
+            if img is None:
+                continue
+            if self.analyzer is not None:
+                box, angle, landmarks = self.analyzer.analyze(img, entry.get("landmarks"))
+                analyses[i] = {"landmarks": landmarks}
+            else:
+                box, angle = self.fd.detect_face_box(img)
+            if box is None:
+                if use_cache:
+                    cache.update(keys[i], age=-1, box=None, angle=0, **analyses[i])
+                continue
+            roi = crop_face(img, box, angle)
+            results[i] = (-1, roi, angle)
+            boxes[i] = box
+            found.append(i)
+            blobs.append(cv2.resize(roi, (224, 224)))
+        if service is not None:
+            futures = [service.submit(blob) for blob in blobs]
+            batches = [(found, [future.result() for future in futures])]
+        else:
+            batches = ((found[start:start+self.batch_size], self.forward(blobs[start:start+self.batch_size]))
+                       for start in range(0, len(blobs), self.batch_size))
+        for batch_found, ages in batches:
+            for i, age in zip(batch_found, ages):
+                _, roi, angle = results[i]
+                results[i] = (age, roi, angle)
+                if cache is not None and keys[i] is not None:
+                    cache.update(keys[i], age=age, box=boxes[i], angle=angle, **analyses[i])
+        return results
+
+    # run a list of 224x224 face ROIs through the age model in one forward pass
+    # returns the list of apparent ages in the same order
+    # the model keeps its input between setInput and forward, so only one thread can use it at a time
+    def forward(self, rois):
+        img_blob = cv2.dnn.blobFromImages(rois)
+        with self.lock, METRICS.timer("age_model"):
+            self.age_model.setInput(img_blob)
+            age_dists = self.age_model.forward()
+        METRICS.inc("age_model_faces_total", len(rois))
+        apparent_ages = np.sum(age_dists * self.output_indexes, axis=1)
+        return [round(float(age), 2) for age in apparent_ages]
+
+
+# runs the age model of an AgePredictor for many threads at once
+# ROIs submitted by any thread are queued, and a dispatcher thread gathers them into batches of up to
+# max_batch_size ROIs, waiting at most max_wait seconds for a batch to fill up after its first ROI arrives
+# every batch is a single forward pass, and each ROI's age is handed back through a future
+class AgeInferenceService:
+    def __init__(self, predictor, max_batch_size=32, max_wait=0.005):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rois = 0
+        self.largest_batch = 0
+        # the dispatcher thread is started on first use, in the process that uses the service
+        # threads don't survive a fork, so a service created before forking gets its own dispatcher in every child
+        self.dispatcher_pid = None
+
+    # queue a 224x224 face ROI, returns a future for its apparent age
+    def submit(self, roi):
+        with self.lock:
+            if self.dispatcher_pid != os.getpid():
+                self.dispatcher_pid = os.getpid()
+                threading.Thread(target=self.dispatch, daemon=True).start()
+        future = Future()
+        self.requests.put((roi, future))
+        return future
+
+    # queue depth and batch size statistics
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth": self.requests.qsize(),
+                "batches": self.batches,
+                "rois": self.rois,
+                "mean_batch_size": self.rois / self.batches if self.batches > 0 else 0,
+                "largest_batch_size": self.largest_batch,
+            }
+
+    def dispatch(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            rois = [roi for roi, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                ages = self.predictor.forward(rois)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, age in zip(futures, ages):
+                future.set_result(age)
+            with self.lock:
+                self.batches += 1
+                self.rois += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
 
 
 # if __name__ == "__main__":
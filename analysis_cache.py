@@ -0,0 +1,114 @@
+import numpy as np
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+from metrics import METRICS
+
+
+# cache of the results of face analysis, keyed by a hash of the image they were computed from
+# each entry is a dict that can hold any of the following fields:
+## age: the apparent age predicted by the age model (-1 if no face was found)
+## box: the (x, y, w, h) face ROI in the rotated image, None if no face was found
+## angle: the rotation angle (in CCW) for the face ROI
+## landmarks: the 68 face landmarks in the original image
+## aligned: a dict from alignment key (see video_maker.align_faces) to the landmarks in the aligned image
+# entries are evicted least-recently-used first once their estimated size exceeds max_bytes
+# if path is given, every entry is also persisted there and reloaded on a miss, so the cache survives restarts
+class AnalysisCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    # hash of an encoded image (bytes) or a decoded image (numpy array), used as the key of its entry
+    @staticmethod
+    def key(data):
+        h = hashlib.sha1()
+        if isinstance(data, np.ndarray):
+            h.update(str(data.shape).encode())
+            h.update(np.ascontiguousarray(data).data)
+        else:
+            h.update(data)
+        return h.hexdigest()
+
+    # return a copy of the entry for key, or an empty dict if there is none
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                METRICS.inc("analysis_cache_hits_total", source="memory")
+                return dict(self.entries[key])
+        entry = self.load(key)
+        if entry is None:
+            METRICS.inc("analysis_cache_misses_total")
+            return {}
+        METRICS.inc("analysis_cache_hits_total", source="disk")
+        with self.lock:
+            self.store(key, entry)
+        return dict(entry)
+
+    # add or overwrite fields of the entry for key
+    # "aligned" is merged with the alignments already in the entry rather than replacing them
+    def update(self, key, **fields):
+        with self.lock:
+            entry = dict(self.entries.get(key) or self.load(key) or {})
+            if "aligned" in fields:
+                fields["aligned"] = dict(entry.get("aligned", {}), **fields["aligned"])
+            entry.update(fields)
+            self.store(key, entry)
+        self.save(key, entry)
+
+    # put entry in memory as the most recently used one, then evict until under budget
+    # must be called with the lock held
+    def store(self, key, entry):
+        if key in self.entries:
+            self.total_bytes -= self.sizes[key]
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.sizes[key] = self.estimate_size(entry)
+        self.total_bytes += self.sizes[key]
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            evicted, _ = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(evicted)
+
+    # rough number of bytes held by an entry, dominated by the landmark arrays
+    @staticmethod
+    def estimate_size(entry):
+        size = sys.getsizeof(entry)
+        for value in entry.values():
+            if isinstance(value, dict):
+                size += sys.getsizeof(value) + sum(AnalysisCache.estimate_size({"": v}) for v in value.values())
+            elif isinstance(value, np.ndarray):
+                size += value.nbytes + 112
+            else:
+                size += sys.getsizeof(value)
+        return size
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + ".pkl")
+
+    def load(self, key):
+        if self.path is None or not os.path.exists(self.entry_path(key)):
+            return None
+        try:
+            with open(self.entry_path(key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, key, entry):
+        if self.path is None:
+            return
+        # write to a temporary file first so that readers never see a partial entry
+        tmp_path = self.entry_path(key) + "." + str(threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, self.entry_path(key))
@@ -0,0 +1,290 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+
+import video_maker as VideoMaker
+import extrapolate_vector_field as evf
+from warp_image import ImageWarper
+from face_detector import rotate_image
+
+
+# offline benchmarks of the render pipeline
+# everything runs on synthetic 800*600 faces with synthetic 68 point landmarks, so no model files or network are needed
+# every case runs in a fresh process, so that its peak RSS is its own
+# results are printed and optionally written as JSON, and can be compared against the JSON of an earlier run:
+# $ python3 benchmark.py --output baseline.json
+# $ python3 benchmark.py --baseline baseline.json
+# exits with status 1 if any case got slower than the baseline by more than the tolerance
+
+
+# 68 point landmarks of a synthetic face, in the same layout as dlib's shape predictor:
+# jaw 0-16, eyebrows 17-26, nose 27-35, eyes 36-47, mouth 48-67
+# (cx, cy) is the center of the face and scale its half width (in px)
+def synthetic_landmarks(cx=400, cy=300, scale=150, rng=None):
+    t = np.linspace(-np.pi * 0.45, np.pi * 0.45, 17)
+    jaw = np.column_stack((np.sin(t), 0.2 + np.cos(t) * 1.1))
+    brows = np.column_stack((np.concatenate((np.linspace(-0.75, -0.15, 5), np.linspace(0.15, 0.75, 5))),
+                             np.full(10, -0.55)))
+    nose = np.column_stack((np.concatenate((np.zeros(4), np.linspace(-0.2, 0.2, 5))),
+                            np.concatenate((np.linspace(-0.4, 0.05, 4), np.full(5, 0.15)))))
+    eye = np.column_stack((np.cos(np.linspace(np.pi, -np.pi, 6, endpoint=False)) * 0.18,
+                           np.sin(np.linspace(np.pi, -np.pi, 6, endpoint=False)) * 0.07))
+    eyes = np.concatenate((eye + (-0.42, -0.35), eye + (0.42, -0.35)))
+    outer = np.column_stack((np.cos(np.linspace(np.pi, -np.pi, 12, endpoint=False)) * 0.4,
+                             0.55 + np.sin(np.linspace(np.pi, -np.pi, 12, endpoint=False)) * 0.15))
+    inner = np.column_stack((np.cos(np.linspace(np.pi, -np.pi, 8, endpoint=False)) * 0.3,
+                             0.55 + np.sin(np.linspace(np.pi, -np.pi, 8, endpoint=False)) * 0.05))
+    points = np.concatenate((jaw, brows, nose, eyes, outer, inner)) * scale + (cx, cy)
+    if rng is not None:
+        points += rng.normal(0, scale * 0.03, points.shape)
+    return np.rint(points).astype("int")
+
+
+# a synthetic aligned face of the given (width, height) drawn around its landmarks, and the landmarks
+def synthetic_face(rng, size=(800, 600)):
+    w, h = size
+    img = np.empty((h, w, 3), dtype=np.uint8)
+    img[:] = rng.integers(40, 200, 3)
+    # some texture, so that the encoder has something to do
+    noise = rng.integers(0, 40, (h // 8, w // 8, 3), dtype=np.uint8)
+    img += cv2.resize(noise, (w, h))
+    landmarks = synthetic_landmarks(w / 2 + rng.normal(0, w * 0.01), h / 2 + rng.normal(0, h * 0.01),
+                                    min(w, h) / 4, rng)
+    skin = tuple(int(c) for c in rng.integers(90, 230, 3))
+    cv2.fillConvexPoly(img, cv2.convexHull(landmarks.astype(np.int32)), skin)
+    for start, end in ((17, 22), (22, 27), (27, 31), (36, 42), (42, 48), (48, 60)):
+        cv2.polylines(img, [landmarks[start:end].astype(np.int32)], end - start > 5, (30, 30, 60), 2)
+    return img, landmarks
+
+
+# an album of n synthetic faces with their landmarks
+def synthetic_album(n, size=(800, 600), seed=0):
+    rng = np.random.default_rng(seed)
+    faces, landmarks = zip(*(synthetic_face(rng, size) for i in range(n)))
+    return list(faces), list(landmarks)
+
+
+# time fn() repeat times, returns the fastest time (in seconds)
+def best_time(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# the benchmark cases, each takes its params and returns a dict of measurements:
+## seconds: the time (in seconds) of one run
+## fps: frames rendered (and written, if any) per second, for the cases that produce frames
+## per_second: operations per second, for the cases that don't
+def bench_extrapolate(params):
+    faces, landmarks = synthetic_album(2)
+    l1, l2 = landmarks
+    def run():
+        # a new Extrapolator every time, otherwise the triangulation is cached
+        evf.Extrapolator().extrapolate(l2[:, 0], l2[:, 1], l1[:, 0] - l2[:, 0], l1[:, 1] - l2[:, 1], (600, 800))
+    seconds = best_time(run, params["repeat"])
+    return {"seconds": seconds, "per_second": 1 / seconds}
+
+
+def bench_warp(params):
+    faces, landmarks = synthetic_album(2)
+    fx, fy, _, _ = VideoMaker.morph_fields(evf.Extrapolator(), landmarks[0], landmarks[1], (600, 800))
+    w = ImageWarper()
+    dst = np.empty_like(faces[0])
+    seconds = best_time(lambda: w.warp(faces[0], fx, fy, 0.5, dst=dst), params["repeat"])
+    return {"seconds": seconds, "per_second": 1 / seconds}
+
+
+def bench_rotate_image(params):
+    faces, _ = synthetic_album(1)
+    seconds = best_time(lambda: rotate_image(faces[0], degreesCCW=params["angle"]), params["repeat"])
+    return {"seconds": seconds, "per_second": 1 / seconds}
+
+
+# only rendering, no encoding
+def bench_morph_frames(params):
+    faces, landmarks = synthetic_album(params["faces"])
+    frames = VideoMaker.morph_frames(faces, landmarks, params["interval"], params["pause"], params["fps"],
+                                     params["morph_engine"])
+    start = time.perf_counter()
+    n = sum(1 for frame in frames)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "fps": n / seconds, "frames": n}
+
+
+# only encoding, of frames that are rendered beforehand
+def bench_encode(params):
+    faces, _ = synthetic_album(params["faces"])
+    n = params["frames"]
+    with tempfile.TemporaryDirectory() as tmp:
+        out = VideoMaker.open_writer(os.path.join(tmp, "out.mp4"), 30, VideoMaker.frame_size(faces),
+                                     params["encoder"])
+        start = time.perf_counter()
+        VideoMaker.write_frames(out, (faces[i % len(faces)] for i in range(n)), n)
+        out.release()
+        seconds = time.perf_counter() - start
+    return {"seconds": seconds, "fps": n / seconds, "frames": n}
+
+
+def bench_make_video(params):
+    faces, landmarks = synthetic_album(params["faces"])
+    with tempfile.TemporaryDirectory() as tmp:
+        frames = []
+        start = time.perf_counter()
+        VideoMaker.make_video(faces, landmarks, os.path.join(tmp, "out.mp4"), interval=params["interval"],
+                              pause=params["pause"], fps=params["fps"], workers=params["workers"],
+                              encoder=params["encoder"], morph_engine=params["morph_engine"],
+                              progress=lambda done, total: frames.append(done))
+        seconds = time.perf_counter() - start
+    n = frames[-1] if frames else 0
+    return {"seconds": seconds, "fps": n / seconds, "frames": n}
+
+
+def bench_make_video_nomorph(params):
+    faces, _ = synthetic_album(params["faces"])
+    with tempfile.TemporaryDirectory() as tmp:
+        frames = []
+        start = time.perf_counter()
+        VideoMaker.make_video_nomorph(faces, os.path.join(tmp, "out.mp4"), pause=params["pause"], fps=params["fps"],
+                                      encoder=params["encoder"], progress=lambda done, total: frames.append(done))
+        seconds = time.perf_counter() - start
+    n = frames[-1] if frames else 0
+    return {"seconds": seconds, "fps": n / seconds, "frames": n}
+
+
+BENCHMARKS = {
+    "extrapolate": bench_extrapolate,
+    "warp": bench_warp,
+    "rotate_image": bench_rotate_image,
+    "morph_frames": bench_morph_frames,
+    "encode": bench_encode,
+    "make_video": bench_make_video,
+    "make_video_nomorph": bench_make_video_nomorph,
+}
+
+
+# the list of (name, params) cases to run
+# quick cuts the album sizes, frame rates and durations down to one each
+def cases(quick=False):
+    album_sizes = [3] if quick else [3, 10]
+    fps_values = [15] if quick else [15, 30]
+    intervals = [0.5] if quick else [0.5, 1]
+    encoders = ["opencv"] + (["ffmpeg"] if shutil.which("ffmpeg") else [])
+    repeat = 3 if quick else 5
+    result = [
+        ("extrapolate", {"repeat": repeat}),
+        ("warp", {"repeat": repeat * 4}),
+    ]
+    for angle in [10, 30]:
+        result.append(("rotate_image", {"angle": angle, "repeat": repeat * 4}))
+    for engine in VideoMaker.MORPH_ENGINES:
+        result.append(("morph_frames", {"faces": album_sizes[0], "interval": 1, "pause": 0, "fps": 30,
+                                        "morph_engine": engine}))
+    for encoder in encoders:
+        result.append(("encode", {"faces": 3, "frames": 60 if quick else 150, "encoder": encoder}))
+    for n in album_sizes:
+        for fps in fps_values:
+            for interval in intervals:
+                for encoder in encoders:
+                    result.append(("make_video", {"faces": n, "fps": fps, "interval": interval, "pause": 0.5,
+                                                  "workers": 1, "encoder": encoder, "morph_engine": "field"}))
+            for encoder in encoders:
+                result.append(("make_video_nomorph", {"faces": n, "fps": fps, "pause": 1, "encoder": encoder}))
+    return result
+
+
+# run a single case in this process, returns its measurements plus the peak RSS (in MB) of the process
+def run_case(name, params):
+    result = BENCHMARKS[name](params)
+    # ru_maxrss is in kB on Linux, but in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return result
+
+
+# key that identifies a case across runs
+def case_key(name, params):
+    return name + json.dumps(params, sort_keys=True)
+
+
+# compare results against the results of a baseline run
+# returns the list of (result, baseline result, ratio of seconds) for every case that is in both
+def compare(results, baseline):
+    previous = {case_key(r["name"], r["params"]): r for r in baseline["results"]}
+    comparison = []
+    for r in results:
+        b = previous.get(case_key(r["name"], r["params"]))
+        if b is not None:
+            comparison.append((r, b, r["seconds"] / b["seconds"]))
+    return comparison
+
+
+def describe(params):
+    return " ".join(k + "=" + str(v) for k, v in sorted(params.items()) if k != "repeat")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the render pipeline on synthetic faces")
+    parser.add_argument("--quick", action="store_true", help="run a smaller set of cases")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against the JSON results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction by which a case may be slower than the baseline (default 0.1)")
+    args = parser.parse_args()
+
+    results = []
+    for name, params in cases(args.quick):
+        if args.only and name not in args.only:
+            continue
+        # a fresh process per case, so that peak RSS isn't carried over from earlier cases
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_case, name, params).result()
+        results.append(dict(name=name, params=params, **result))
+        rate = "%.1f fps" % result["fps"] if "fps" in result else "%.1f/s" % result["per_second"]
+        print("%-20s %-70s %9.4f s  %12s  %7.1f MB" % (name, describe(params), result["seconds"], rate,
+                                                      result["peak_rss_mb"]))
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(results, json.load(f))
+        regressions = 0
+        print()
+        for r, b, ratio in comparison:
+            flag = ""
+            if ratio > 1 + args.tolerance:
+                flag = "  SLOWER"
+                regressions += 1
+            elif ratio < 1 - args.tolerance:
+                flag = "  faster"
+            print("%-20s %-70s %9.4f s -> %9.4f s  x%.2f%s" % (r["name"], describe(r["params"]), b["seconds"],
+                                                               r["seconds"], ratio, flag))
+        print("%d of %d cases slower than the baseline by more than %d%%" % (regressions, len(comparison),
+                                                                            args.tolerance * 100))
+        sys.exit(1 if regressions > 0 else 0)
@@ -1,6 +1,9 @@
 import numpy as np
 import dlib
 import cv2
+import queue
+from contextlib import contextmanager
+from metrics import METRICS
 # import matplotlib.pyplot as plt
 
 
@@ -11,6 +14,7 @@ class FaceLandmarkDetector:
     def __init__(self):
         self.detector = dlib.get_frontal_face_detector()
         self.predictor = dlib.shape_predictor(self.PREDICTOR_PATH)
+        METRICS.inc("models_loaded_total", model="landmarks")
 
     # @staticmethod
     # def plot_landmarks(img, landmarks, show_plot=True):
@@ -29,10 +33,21 @@ class FaceLandmarkDetector:
     def predict(self, img):
         # find how many faces there are and the bounding box for each
         # if there are multiple faces, use the first face
-        faces = self.detector(img, 1)
+        with METRICS.timer("detect_landmarks"):
+            faces = self.detector(img, 1)
         if len(faces) == 0:
             return np.empty((0, 2), dtype="int")
-        landmarks = self.predictor(img, faces[0]).parts()
+        return self.predict_rect(img, faces[0])
+
+    # landmarks of the face in the given (x, y, w, h) box of img, found by some other detector
+    def predict_box(self, img, box):
+        x, y, w, h = box
+        return self.predict_rect(img, dlib.rectangle(int(x), int(y), int(x + w), int(y + h)))
+
+    # landmarks of the face in the given dlib.rectangle of img
+    def predict_rect(self, img, rect):
+        with METRICS.timer("detect_landmarks"):
+            landmarks = self.predictor(img, rect).parts()
         # landmarks is a dlib.points object, convert it to np array
         landmarks_np = np.empty((len(landmarks), 2), dtype="int")
         for i in range(len(landmarks)):
@@ -40,6 +55,33 @@ class FaceLandmarkDetector:
         return landmarks_np
 
 
+class FaceLandmarkDetectorPool:
+    """Fixed set of preloaded FaceLandmarkDetectors, each used by at most one thread at a time"""
+
+    def __init__(self, size):
+        self.detectors = queue.Queue()
+        self.size = 0
+        self.resize(size)
+
+    # load or drop detectors until there are size of them, dropping waits for checked out detectors to be returned
+    def resize(self, size):
+        while self.size < size:
+            self.detectors.put(FaceLandmarkDetector())
+            self.size += 1
+        while self.size > size:
+            self.detectors.get()
+            self.size -= 1
+
+    # borrow a detector for the duration of a with block, waiting for one to be returned if all are in use
+    @contextmanager
+    def checkout(self):
+        d = self.detectors.get()
+        try:
+            yield d
+        finally:
+            self.detectors.put(d)
+
+
 # if __name__ == '__main__':
 #     face_filename = './data/head1.jpg'
 #     face = cv2.imread(face_filename)
@@ -1,12 +1,19 @@
 import numpy as np
 # import matplotlib.pyplot as plt
-from scipy import interpolate
+from collections import OrderedDict
+from scipy.spatial import Delaunay
 
 class Extrapolator:
     """Extrapolate and interpolate a sparse vector field into a dense one"""
 
-    def __init__(self):
-        return
+    def __init__(self, cache_size=3):
+        # zero-length boundary points and regular grid points, built once per out_size
+        self.boundaries = {}
+        self.grids = {}
+        # barycentric weights of the grid points for the most recently used sparse point sets
+        # make_video uses each set of landmarks for two consecutive face pairs, with two other sets in between
+        self.weights = OrderedDict()
+        self.cache_size = cache_size
 
     # @staticmethod
     # def plot_vector_field(x, y, step=1, scale=1, show_plot=True):
@@ -22,37 +29,65 @@ class Extrapolator:
     def extrapolate(self, x, y, z1, z2, out_size):
         # Given two sparse functions f1(x, y) = z1 and f2(x, y) = z2, calculate function values z1_out and z2_out on
         # each point of a regular grid with dimensions out_size
+        vertices, weights = self.get_weights(x, y, out_size)
 
-        # add zero-length vectors to boundary (x=0 or x=width-1, y=0 or y=height-1) in the sparse field
-        # top edge
-        x_padded = np.concatenate((x, np.arange(0, out_size[1])))
-        y_padded = np.concatenate((y, np.zeros(out_size[1], dtype=int)))
-        z1_padded = np.concatenate((z1, np.zeros(out_size[1], dtype=float)))
-        z2_padded = np.concatenate((z2, np.zeros(out_size[1], dtype=float)))
-        # left edge
-        x_padded = np.concatenate((x_padded, np.zeros(out_size[0]-1, dtype=int)))
-        y_padded = np.concatenate((y_padded, np.arange(1, out_size[0])))
-        z1_padded = np.concatenate((z1_padded, np.zeros(out_size[0]-1, dtype=float)))
-        z2_padded = np.concatenate((z2_padded, np.zeros(out_size[0]-1, dtype=float)))
-        # right edge
-        x_padded = np.concatenate((x_padded, np.full(out_size[0]-1, out_size[1]-1)))
-        y_padded = np.concatenate((y_padded, np.arange(1, out_size[0])))
-        z1_padded = np.concatenate((z1_padded, np.zeros(out_size[0]-1, dtype=float)))
-        z2_padded = np.concatenate((z2_padded, np.zeros(out_size[0]-1, dtype=float)))
-        # bottom edge
-        x_padded = np.concatenate((x_padded, np.arange(1, out_size[1]-1)))
-        y_padded = np.concatenate((y_padded, np.full(out_size[1]-2, out_size[0]-1)))
-        z1_padded = np.concatenate((z1_padded, np.zeros(out_size[1]-2, dtype=float)))
-        z2_padded = np.concatenate((z2_padded, np.zeros(out_size[1]-2, dtype=float)))
-
-        # interpolate all points using griddata
-        points = np.column_stack((y_padded, x_padded))
-        grid_y, grid_x = np.mgrid[0:out_size[0], 0:out_size[1]]
-        z1_out = interpolate.griddata(points, z1_padded, (grid_y, grid_x), method="linear")
-        z2_out = interpolate.griddata(points, z2_padded, (grid_y, grid_x), method="linear")
+        # pad both functions with zero-length vectors on the boundary and interpolate them together
+        z_padded = np.zeros((len(z1) + len(self.get_boundary(out_size)), 2))
+        z_padded[:len(z1), 0] = z1
+        z_padded[:len(z2), 1] = z2
+        z_out = np.einsum("nj,njk->nk", weights, z_padded[vertices])
 
+        z1_out = z_out[:, 0].reshape(out_size[:2])
+        z2_out = z_out[:, 1].reshape(out_size[:2])
         return z1_out, z2_out
 
+    # (y, x) coordinates of the boundary (x=0 or x=width-1, y=0 or y=height-1)
+    # in the order top edge, left edge, right edge, bottom edge, with every boundary pixel appearing once
+    def get_boundary(self, out_size):
+        key = tuple(out_size[:2])
+        if key not in self.boundaries:
+            height, width = key
+            top = np.column_stack((np.zeros(width, dtype=int), np.arange(0, width)))
+            left = np.column_stack((np.arange(1, height), np.zeros(height-1, dtype=int)))
+            right = np.column_stack((np.arange(1, height), np.full(height-1, width-1)))
+            bottom = np.column_stack((np.full(width-2, height-1), np.arange(1, width-1)))
+            self.boundaries[key] = np.concatenate((top, left, right, bottom))
+        return self.boundaries[key]
+
+    # (y, x) coordinates of every point of the regular grid, flattened in row-major order
+    def get_grid(self, out_size):
+        key = tuple(out_size[:2])
+        if key not in self.grids:
+            grid_y, grid_x = np.mgrid[0:key[0], 0:key[1]]
+            self.grids[key] = np.column_stack((grid_y.ravel(), grid_x.ravel())).astype(float)
+        return self.grids[key]
+
+    # triangulate the sparse points plus the boundary, then find for every grid point
+    # the 3 vertices of its enclosing triangle and its barycentric weights with respect to them
+    # this is the same piecewise linear interpolation that scipy.interpolate.griddata(method="linear") does,
+    # but the result only depends on the point set, so it is cached and applied to any number of functions
+    def get_weights(self, x, y, out_size):
+        points = np.concatenate((np.column_stack((y, x)), self.get_boundary(out_size))).astype(float)
+        key = (tuple(out_size[:2]), points.tobytes())
+        if key in self.weights:
+            self.weights.move_to_end(key)
+            return self.weights[key]
+
+        tri = Delaunay(points)
+        grid = self.get_grid(out_size)
+        simplex = tri.find_simplex(grid)
+        vertices = tri.simplices[simplex]
+        transform = tri.transform[simplex]
+        bary = np.einsum("nij,nj->ni", transform[:, :2], grid - transform[:, 2])
+        weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+        # same as griddata, grid points outside of the triangulation get nan
+        weights[simplex == -1] = np.nan
+
+        self.weights[key] = (vertices, weights)
+        if len(self.weights) > self.cache_size:
+            self.weights.popitem(last=False)
+        return vertices, weights
+
 
 # if __name__ == '__main__':
 #     img_size = [100, 200]
@@ -0,0 +1,70 @@
+import numpy as np
+import cv2
+from face_detector import rotate_image, rotation_matrix, transform_landmarks
+from detect_landmarks import FaceLandmarkDetectorPool
+
+
+# locates a face once and derives everything that the age model and the face alignment need from that one detection
+# the face is found by dlib's frontal face detector, the 68 landmarks are predicted in its box, and the ROI for the
+# age model is derived from the landmarks (see roi_box) instead of running a second detector
+# detectors is the FaceLandmarkDetectorPool that the dlib models are borrowed from (by default a pool of one)
+# fallback, if given, is a FaceDetector that is tried when dlib finds no face: its rotated search also finds tilted
+# faces, and the landmarks are then predicted in its box in the rotated image
+class FaceAnalyzer:
+    def __init__(self, detectors=None, fallback=None):
+        self.detectors = detectors if detectors is not None else FaceLandmarkDetectorPool(1)
+        self.fallback = fallback
+
+    # locate the face in img, or use its landmarks if they are already known
+    # 3 return values:
+    ## box is the (x, y, w, h) ROI for the age model in img rotated by angle, see face_detector.crop_face
+    ## angle is the rotation angle (in CCW) for the ROI
+    ## landmarks are the 68 face landmarks in img
+    # if no face is found, returns (None, 0, empty landmarks)
+    def analyze(self, img, landmarks=None):
+        if landmarks is None:
+            landmarks = self.predict(img)
+        if landmarks.shape == (0, 2):
+            return None, 0, landmarks
+        box, angle = roi_box(img, landmarks)
+        return box, angle, landmarks
+
+    # the landmarks of the face in img, same as FaceLandmarkDetector.predict but with the fallback detector,
+    # so that a FaceAnalyzer can be given to video_maker.align_faces as its detector
+    def predict(self, img):
+        with self.detectors.checkout() as d:
+            landmarks = d.predict(img)
+        if landmarks.shape != (0, 2) or self.fallback is None:
+            return landmarks
+        box, angle = self.fallback.detect_face_box(img)
+        if box is None:
+            return landmarks
+        img_rotated, M = rotate_image(img, degreesCCW=angle)
+        with self.detectors.checkout() as d:
+            landmarks = d.predict_box(img_rotated, box)
+        # map the landmarks back from the rotated image
+        return np.rint(transform_landmarks(landmarks, cv2.invertAffineTransform(M))).astype("int")
+
+
+# the ROI for the age model, derived from the 68 landmarks of the face in img
+# the image is rotated so that the eyes are level, and the ROI is a square around the landmarks in the rotated
+# image, moved up to take in the forehead like the boxes of the Haar cascade do
+# returns the (x, y, w, h) box in the rotated image and the rotation angle (in CCW)
+def roi_box(img, landmarks):
+    eye1 = landmarks[36]
+    eye2 = landmarks[45]
+    angle = float(np.degrees(np.arctan2(eye2[1] - eye1[1], eye2[0] - eye1[0])))
+    # the age model doesn't mind a slight tilt, and an upright ROI is cropped without rotating the image
+    if abs(angle) < 1:
+        angle = 0
+    M, (width, height) = rotation_matrix(img.shape, degreesCCW=angle)
+    points = transform_landmarks(landmarks, M)
+    (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    side = 1.1 * max(x1 - x0, y1 - y0)
+    cx = 0.5 * (x0 + x1)
+    cy = 0.5 * (y0 + y1) - 0.1 * side
+    x = int(max(cx - side / 2, 0))
+    y = int(max(cy - side / 2, 0))
+    w = int(min(cx + side / 2, width)) - x
+    h = int(min(cy + side / 2, height)) - y
+    return (x, y, w, h), angle
@@ -1,46 +1,115 @@
 import numpy as np
 import cv2
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os import walk
+from metrics import METRICS
 
 
 # wrapper for a functionality that finds the ROI for a face in an image
+# in fast mode, the search runs on a copy of the image downscaled so that its longer side is at most search_size,
+# and all angles are searched concurrently by a pool of worker threads
 class FaceDetector:
-    def __init__(self):
+    ANGLES = [0, 10, -10, 20, -20, 30, -30]
+
+    def __init__(self, fast=False, search_size=640, workers=len(ANGLES)):
         self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        METRICS.inc("models_loaded_total", model="haar")
+        self.fast = fast
+        self.search_size = search_size
+        self.executor = ThreadPoolExecutor(max_workers=workers) if fast else None
+        # cascade classifiers are not thread-safe, each worker thread loads its own
+        self.local = threading.local()
 
     # detect the face in the given image
     # return ROI (cropped image) that defines the face region, as well as the rotation of the ROI
     # this ROI can be rotated to make the face appear more upright
     # if there are multiple faces in the image, return the first one
     def detect_face(self, img):
+        box, angle = self.detect_face_box(img)
+        if box is None:
+            return None, 0
+        return crop_face(img, box, angle), angle
+
+    # same as detect_face, but return the (x, y, w, h) box of the ROI in the rotated image instead of the ROI itself
+    def detect_face_box(self, img):
+        with METRICS.timer("detect_face"):
+            return self.search(img)
+
+    # the search behind detect_face_box
+    def search(self, img):
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        angles = [0, 10, -10, 20, -20, 30, -30]
-        for a in angles:
-            img_rotated, _ = rotate_image(img, degreesCCW=a)
-            gray_rotated, _ = rotate_image(gray, degreesCCW=a)
-            faces = self.face_cascade.detectMultiScale(gray_rotated, 1.2, 5)
-            if len(faces) > 0:
-                area_largest = float("-inf")
-                best = -1
-                for i in range(len(faces)): # if multiple ROIs are detected pick the largest one
-                    x, y, w, h = faces[i]
-                    area = w * h
-                    if area > area_largest:
-                        area_largest = area
-                        best = i
-                x, y, w, h = faces[best]
-                roi = img_rotated[int(y):int(y+h), int(x):int(x+w)]
-                return roi, a
+        if not self.fast:
+            for a in self.ANGLES:
+                faces = self.detect_rotated(self.face_cascade, gray, a)
+                if len(faces) > 0:
+                    return largest_box(faces), a
+        else:
+            # boxes found on the downscaled image scale back up linearly, since the rotation is about the center
+            sf = min(1., self.search_size / max(gray.shape))
+            if sf < 1:
+                gray = cv2.resize(gray, None, fx=sf, fy=sf, interpolation=cv2.INTER_AREA)
+            futures = [self.executor.submit(self.detect_rotated, None, gray, a) for a in self.ANGLES]
+            # the angles are still tried in order: the first angle with a face wins, the rest is cancelled
+            for a, future in zip(self.ANGLES, futures):
+                faces = future.result()
+                if len(faces) > 0:
+                    for f in futures:
+                        f.cancel()
+                    x, y, w, h = largest_box(faces)
+                    return (int(x / sf), int(y / sf), int(w / sf), int(h / sf)), a
         sys.stderr.write("Warning: FaceDetector: no face detected\n")
         return None, 0
 
+    # run the face cascade on the gray image rotated by the given angle (in CCW)
+    # if no cascade is given, use the one that belongs to the current thread
+    def detect_rotated(self, cascade, gray, angle):
+        if cascade is None:
+            if not hasattr(self.local, "face_cascade"):
+                self.local.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            cascade = self.local.face_cascade
+        gray_rotated, _ = rotate_image(gray, degreesCCW=angle)
+        return cascade.detectMultiScale(gray_rotated, 1.2, 5)
+
+
+# if multiple ROIs are detected pick the largest one
+# returns its (x, y, w, h) box
+def largest_box(faces):
+    area_largest = float("-inf")
+    best = -1
+    for i in range(len(faces)):
+        x, y, w, h = faces[i]
+        area = w * h
+        if area > area_largest:
+            area_largest = area
+            best = i
+    x, y, w, h = faces[best]
+    return int(x), int(y), int(w), int(h)
+
+
+# crop the face ROI given by box (x, y, w, h) out of img rotated by angle (in CCW)
+def crop_face(img, box, angle):
+    x, y, w, h = box
+    if angle == 0:
+        return img[y:y+h, x:x+w]
+    img_rotated, _ = rotate_image(img, degreesCCW=angle)
+    return img_rotated[y:y+h, x:x+w]
+
 
 # a utility tool used to rotate images to detect angled faces
 # returns the rotated image as numpy array and the affine transformation matrix
 def rotate_image(img, scaleFactor=1, degreesCCW=30):
+    M, dsize = rotation_matrix(img.shape, scaleFactor, degreesCCW)
+    rotatedImg = cv2.warpAffine(img, M, dsize=dsize)
+    return rotatedImg, M
+
+
+# the affine transformation matrix used by rotate_image for an image of the given shape,
+# and the (width, height) of the rotated image
+def rotation_matrix(shape, scaleFactor=1, degreesCCW=30):
     # note: numpy uses (y,x) convention but most OpenCV functions use (x,y)
-    (oldY, oldX) = img.shape[:2]
+    (oldY, oldX) = shape[:2]
     # rotate about center of image
     M = cv2.getRotationMatrix2D(center=(oldX/2,oldY/2), angle=degreesCCW, scale=scaleFactor)
     # choose a new image size.
@@ -49,7 +118,7 @@ def rotate_image(img, scaleFactor=1, degreesCCW=30):
     r = np.deg2rad(degreesCCW)
     newX, newY = (abs(np.sin(r)*newY) + abs(np.cos(r)*newX), abs(np.sin(r)*newX) + abs(np.cos(r)*newY))
 
-    # the warpAffine function call, below, basically works like this:
+    # the warpAffine function call, in rotate_image, basically works like this:
     # 1. apply the M transformation on each pixel of the original image
     # 2. save everything that falls within the upper-left "dsize" portion of the resulting image.
 
@@ -57,9 +126,12 @@ def rotate_image(img, scaleFactor=1, degreesCCW=30):
     (tx,ty) = ((newX-oldX)/2,(newY-oldY)/2)
     M[0,2] += tx # third column of matrix holds translation, which takes effect after rotation.
     M[1,2] += ty
+    return M, (int(newX),int(newY))
 
-    rotatedImg = cv2.warpAffine(img, M, dsize=(int(newX),int(newY)))
-    return rotatedImg, M
+
+# apply the 2x3 affine transformation matrix M to every (x, y) row of landmarks
+def transform_landmarks(landmarks, M):
+    return np.matmul(np.column_stack((landmarks, np.ones(len(landmarks)))), np.asarray(M).T)
 
 
 # if __name__ == "__main__":
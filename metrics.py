@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import nullcontext
+
+
+# upper bounds (in seconds) of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+# counters and latency histograms of the pipeline, exported in the Prometheus text format by render
+# every timed stage goes into the histogram "stage_seconds" with the stage name as its label, and is also added to
+# the breakdown of the request that the current thread is working on, if any (see request)
+# when disabled, timer returns a shared no-op context manager and inc and observe return right away,
+# so instrumented code costs next to nothing
+# each process collects its own metrics, processes that serve the same app, e.g. the workers of a PreforkServer, can
+# report the sum over all of them by sharing their metrics (see share)
+class Metrics:
+    def __init__(self, enabled=True, prefix="timelapse_", buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of (label, value) pairs
+        self.counters = defaultdict(float)
+        # (name, labels) -> [count per bucket..., count, sum]
+        self.histograms = {}
+        self.local = threading.local()
+        # directory that the metrics are shared through, and the name of the file of this process in there
+        self.shared_dir = None
+        self.shared_name = None
+
+    # context manager that times the block as the given stage
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, stage)
+
+    # record seconds spent in the given stage, for time that was measured some other way, e.g. summed over a loop
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        self.observe("stage_seconds", seconds, stage=stage)
+        breakdown = getattr(self.local, "breakdown", None)
+        if breakdown is not None:
+            breakdown[stage] = breakdown.get(stage, 0) + seconds
+
+    # add value to a counter
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    # add an observation to a histogram
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    # collect the stages timed by this thread into a new breakdown until end_request is called
+    # returns the breakdown, a dict from stage to seconds, or None when disabled
+    def start_request(self):
+        if not self.enabled:
+            return None
+        self.local.breakdown = {}
+        return self.local.breakdown
+
+    # stop collecting the breakdown of this thread, returns it
+    def end_request(self):
+        breakdown = getattr(self.local, "breakdown", None)
+        self.local.breakdown = None
+        return breakdown
+
+    # forget everything collected so far, e.g. in a forked process whose parent shares what it has collected itself
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    # share the metrics of this process through a file in directory, so that render reports the sum over all the
+    # processes sharing the directory, whichever of them is asked
+    # the file is rewritten every interval seconds and on every render, interval None only writes it now
+    # the files of processes that have exited are kept, so that the sums never go down
+    def share(self, directory, interval=1):
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory
+        self.shared_name = str(os.getpid()) + "-" + uuid.uuid4().hex + ".json"
+        self.write_shared()
+        if interval is not None:
+            threading.Thread(target=self.write_shared_forever, args=(interval,), daemon=True).start()
+
+    def write_shared_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            self.write_shared()
+
+    # write the metrics of this process to its file in the shared directory, returns them as (counters, histograms)
+    def write_shared(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        path = os.path.join(self.shared_dir, self.shared_name)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"counters": [[name, labels, value] for (name, labels), value in counters.items()],
+                       "histograms": [[name, labels, value] for (name, labels), value in histograms.items()]}, f)
+        os.replace(path + ".tmp", path)
+        return counters, histograms
+
+    # the metrics of this process plus those of the other processes sharing the directory, if any
+    def collect(self):
+        if self.shared_dir is None:
+            with self.lock:
+                return dict(self.counters), {key: list(value) for key, value in self.histograms.items()}
+        counters, histograms = self.write_shared()
+        for name in os.listdir(self.shared_dir):
+            if name == self.shared_name or not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name)) as f:
+                    shared = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for name, labels, value in shared["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in shared["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                histograms[key] = [a + b for a, b in zip(histograms.get(key, [0] * len(value)), value)]
+        return counters, histograms
+
+    # all counters and histograms in the Prometheus text exposition format
+    def render(self):
+        counters, histograms = self.collect()
+        counters = sorted(counters.items())
+        histograms = sorted(histograms.items())
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append("# TYPE " + self.prefix + name + " counter")
+                declared.add(name)
+            lines.append(self.prefix + name + format_labels(labels) + " " + format_value(value))
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                lines.append("# TYPE " + self.prefix + name + " histogram")
+                declared.add(name)
+            for bound, count in zip(self.buckets + ("+Inf",), histogram[:len(self.buckets)] + [histogram[-2]]):
+                lines.append(self.prefix + name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " " +
+                             str(count))
+            lines.append(self.prefix + name + "_count" + format_labels(labels) + " " + str(histogram[-2]))
+            lines.append(self.prefix + name + "_sum" + format_labels(labels) + " " + format_value(histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+
+
+NULL_TIMER = nullcontext()
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(label + "=\"" + value + "\"" for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value))
+
+
+# the metrics of this process, shared by all modules
+METRICS = Metrics()
@@ -0,0 +1,150 @@
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+
+
+# production launch mode for a WSGI app: a parent process that forks a fixed number of worker processes
+# everything loaded before serve_forever is called (e.g. model weights) is shared by the workers copy-on-write
+# all workers accept connections from the same listening socket, each with at most `threads` requests at a time
+# signals to the parent:
+## SIGHUP restarts the workers one by one, each old worker finishes its requests in flight before it exits
+## SIGTERM or SIGINT stops all workers the same way, then the parent exits
+# init, if given, is called in every worker right after it is forked, before it starts serving
+# cleanup, if given, is called in every worker once it has stopped serving, e.g. to wait for work it started in the
+# background, the worker exits when it returns
+class PreforkServer:
+    def __init__(self, app, host="0.0.0.0", port=8081, workers=2, threads=8, init=None, cleanup=None):
+        self.app = app
+        self.init = init
+        self.cleanup = cleanup
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.pids = set()
+        self.restart = False
+        self.stopping = False
+
+    def serve_forever(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(128)
+        # keep the garbage collector from touching (and thereby copying) everything loaded so far
+        gc.freeze()
+        signal.signal(signal.SIGHUP, self.on_restart)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        for i in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            if self.restart:
+                self.restart = False
+                self.rolling_restart()
+            self.reap(respawn=True)
+            time.sleep(0.5)
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        while self.pids:
+            self.reap(respawn=False)
+            time.sleep(0.1)
+        self.sock.close()
+
+    def on_restart(self, signum, frame):
+        self.restart = True
+
+    def on_stop(self, signum, frame):
+        self.stopping = True
+
+    # start a new worker process
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.run_worker()
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        self.pids.add(pid)
+        return pid
+
+    # replace the workers one at a time, so that there is always at least `workers` processes accepting
+    def rolling_restart(self):
+        for pid in list(self.pids):
+            self.spawn()
+            os.kill(pid, signal.SIGTERM)
+            while pid in self.pids:
+                self.reap(respawn=False, block=True)
+
+    # collect workers that have exited, replacing ones that exited unexpectedly if respawn is True
+    def reap(self, respawn, block=False):
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.pids.clear()
+                return
+            if pid == 0:
+                return
+            if pid in self.pids:
+                self.pids.remove(pid)
+                if respawn and not self.stopping:
+                    sys.stderr.write("Warning: PreforkServer: worker " + str(pid) + " died, restarting it\n")
+                    self.spawn()
+            if block:
+                return
+
+    def run_worker(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.init is not None:
+            self.init()
+        server = PoolWSGIServer(self.host, self.port, self.app, fd=self.sock.fileno(), threads=self.threads)
+        # serve_forever has to be stopped from another thread
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        server.serve_forever()
+        server.executor.shutdown(wait=True)
+        server.server_close()
+        if self.cleanup is not None:
+            self.cleanup()
+
+
+# werkzeug server that handles requests on a fixed pool of threads
+# while all threads are busy it stops accepting, leaving new connections to the other workers
+class PoolWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, fd=None, threads=8):
+        super().__init__(host, port, app, fd=fd)
+        # the listening socket is shared with the other workers, another one may take a connection first
+        self.socket.setblocking(False)
+        self.slots = threading.BoundedSemaphore(threads)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _handle_request_noblock(self):
+        if not self.slots.acquire(timeout=0.05):
+            return
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            self.slots.release()
+            return
+        request.setblocking(True)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
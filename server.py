@@ -1,15 +1,39 @@
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
 import cv2
 import numpy as np
 import json
-import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
 import base64
-import subprocess
 import re
+import argparse
+import io
+import tarfile
+import zipfile
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
 
 import video_maker as VideoMaker
-from age_predictor import AgePredictor
+from age_predictor import AgePredictor, AgeInferenceService
+from analysis_cache import AnalysisCache
+from detect_landmarks import FaceLandmarkDetectorPool
+from face_analyzer import FaceAnalyzer
+from face_detector import FaceDetector
+from prefork import PreforkServer
+from metrics import METRICS
 
 
 # instantiate the app
@@ -31,16 +55,130 @@ def block_method():
             abort(403)
 
 
+# every request gets a breakdown of the time it spent in each stage of the pipeline (see metrics.Metrics), sent back
+# in a Server-Timing header, and its latency goes into the histogram "request_seconds"
+@app.before_request
+def start_timing():
+    request.start_time = time.perf_counter()
+    METRICS.start_request()
+
+
+@app.after_request
+def finish_timing(response):
+    breakdown = METRICS.end_request()
+    if breakdown is not None:
+        METRICS.observe("request_seconds", time.perf_counter() - request.start_time, endpoint=str(request.endpoint))
+        response.headers["Server-Timing"] = server_timing(breakdown)
+    return response
+
+
+# Server-Timing header value for a breakdown of stage -> seconds
+def server_timing(breakdown):
+    return ", ".join("%s;dur=%.1f" % (stage, seconds * 1000) for stage, seconds in breakdown.items())
+
+
+# ages, face ROIs and landmarks of images seen before, keyed by the hash of the image bytes
+# persisted to disk so that resubmitted images skip all model inference, even after a restart
+ANALYSIS_CACHE = AnalysisCache(max_bytes=64 * 1024 * 1024, path="./data/cache")
+
+
+# number of processes used to render the morph frames of a video
+RENDER_WORKERS = os.cpu_count() or 1
+# number of background render jobs that run at the same time, the rest wait in the queue
+RENDER_JOB_WORKERS = 2
+# finished render jobs are forgotten, and their videos deleted, if nobody fetches them within this many seconds
+RENDER_JOB_TTL = 60 * 60
+# the progress of a running render job is saved at most this often, any other change is saved right away
+RENDER_JOB_SAVE_INTERVAL = 0.5
+# maximum number of requests that a worker process handles at the same time, see --threads
+REQUEST_THREADS = 8
+# every render gets its own temporary workspace in here
+RENDER_DIR = "./data"
+# encoded pauses and morphs of earlier renders, reused when the same faces are rendered again
+SEGMENT_DIR = "./data/segments"
+# the least recently used segments are removed once SEGMENT_DIR grows past this
+SEGMENT_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+# threads that fetch and decode incoming images (OpenCV releases the GIL while decoding)
+INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=2 * (os.cpu_count() or 1))
+# connection pool for images given as http(s) URLs, if urllib3 is available
+HTTP_POOL = urllib3.PoolManager(maxsize=8) if urllib3 is not None else None
+# seconds to wait for the server of an image URL to connect or to send more data
+FETCH_TIMEOUT = 30
+
+
+# threads that estimate the ages of single images for streamed responses
+ESTIMATE_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
+# landmark detectors are loaded once and shared by all requests
+# one per request thread and one per render job worker, so that no render waits for another to return one
+LANDMARK_DETECTORS = FaceLandmarkDetectorPool(REQUEST_THREADS + RENDER_JOB_WORKERS)
+
+
+# faces are located once for both age estimation and alignment: the analyzer finds the landmarks along with the
+# ROI for the age model, and they are cached together, so that alignment of an estimated image needs no detection
+# it borrows its dlib models from LANDMARK_DETECTORS, and falls back to the rotated Haar search for faces that dlib
+# misses
+FACE_ANALYZER = FaceAnalyzer(LANDMARK_DETECTORS, fallback=FaceDetector(fast=True))
+
+
 # everything uses the same age predictor, avoid reinitializing every time
-AGE_PREDICTOR = AgePredictor()
+AGE_PREDICTOR = AgePredictor(analyzer=FACE_ANALYZER)
+# concurrent requests share the age model through a service that batches their faces together
+AGE_SERVICE = AgeInferenceService(AGE_PREDICTOR)
 
 
-# helper function to convert URL to actual image that is read by opencv
-def url2image(url, color=True):
+# a process pool (see VideoMaker.worker_pool) that is created on first use, in the process that uses it
+# a pool created before a fork would share its call and result queues with every forked process, so every worker of a
+# PreforkServer gets a pool of its own
+class ProcessLocalPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+
+    def get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pool = VideoMaker.worker_pool(self.workers)
+            return self.pool
+
+
+# processes that align faces in parallel, each loads its own landmark detector once and keeps it
+# albums with fewer faces than ALIGN_PARALLEL_MIN_FACES are aligned in the request thread instead
+ALIGN_EXECUTOR = ProcessLocalPool(RENDER_WORKERS)
+ALIGN_PARALLEL_MIN_FACES = 8
+
+
+# helper function to fetch the raw (still encoded) bytes of the image behind a URL
+# data URLs (which is what the frontend sends) are decoded in place, other URLs are fetched through HTTP_POOL
+# raises urllib.error.HTTPError if the server answers with an error, same as urlopen
+def url2bytes(url):
     if url == "":
         return None
-    resp = urllib.request.urlopen(url)
-    image = np.asarray(bytearray(resp.read()), dtype="uint8")
+    if url.startswith("data:"):
+        header, _, payload = url.partition(",")
+        if header.endswith(";base64"):
+            return base64.b64decode(payload)
+        return urllib.parse.unquote_to_bytes(payload)
+    if HTTP_POOL is not None:
+        resp = HTTP_POOL.request("GET", url, timeout=FETCH_TIMEOUT)
+        if resp.status >= 400:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return resp.data
+    resp = urllib.request.urlopen(url, timeout=FETCH_TIMEOUT)
+    return resp.read()
+
+
+# helper function to decode the raw bytes of an image into an actual image that is read by opencv
+def bytes2image(data, color=True):
+    if data is None:
+        return None
+    image = np.frombuffer(data, dtype="uint8")
     if color: # by default read the images as colored images
         image = cv2.imdecode(image, cv2.IMREAD_COLOR)
     else: # if optional argument color is given as False, then read as black-and-white image
@@ -48,11 +186,77 @@ def url2image(url, color=True):
     return image
 
 
+# helper function to convert URL to actual image that is read by opencv
+def url2image(url, color=True):
+    return bytes2image(url2bytes(url), color)
+
+
+# fetch the bytes behind many URLs concurrently, in order
+def fetch_all(urls):
+    with METRICS.timer("fetch"):
+        return list(INGEST_EXECUTOR.map(url2bytes, urls))
+
+
+# decode many images concurrently, in order
+# entries of datas that are None, or whose skip flag is set, are not decoded and come out as None
+def decode_all(datas, skip=None):
+    if skip is None:
+        skip = [False] * len(datas)
+    with METRICS.timer("decode"):
+        return list(INGEST_EXECUTOR.map(lambda data, s: None if s else bytes2image(data), datas, skip))
+
+
+# decode images one at a time, in order, as they are consumed
+# at most prefetch images (by default one per CPU) are decoded ahead of the one being used
+def iter_decoded(datas, prefetch=None):
+    if prefetch is None:
+        prefetch = os.cpu_count() or 1
+    datas = iter(datas)
+    pending = deque()
+    while True:
+        for data in islice(datas, prefetch + 1 - len(pending)):
+            pending.append(INGEST_EXECUTOR.submit(bytes2image, data))
+        if len(pending) == 0:
+            return
+        with METRICS.timer("decode"):
+            image = pending.popleft().result()
+        yield image
+
+
+# cache key of the raw bytes of an image, None if there is no image
+def bytes2key(data):
+    return None if data is None else AnalysisCache.key(data)
+
+
+# read the images uploaded as multipart file parts, in order
+# either every image is its own part named "images", or all images are in a single zip or tar part named "archive"
+# returns a list of (filename, bytes) pairs
+def read_uploads(files):
+    if "archive" not in files:
+        return [(f.filename, f.read()) for f in files.getlist("images")]
+    archive = io.BytesIO(files["archive"].read())
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as z:
+            return [(info.filename, z.read(info)) for info in z.infolist() if not info.is_dir()]
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as t:
+        return [(member.name, t.extractfile(member).read()) for member in t.getmembers() if member.isfile()]
+
+
+# predict the ages of the images given as raw (still encoded) bytes, consulting the analysis cache
+# images whose age is already cached are never decoded
+def estimate_ages(datas):
+    keys = list(map(bytes2key, datas))
+    # every key is looked up once, so that the cache metrics count every image once
+    entries = [{} if key is None else ANALYSIS_CACHE.get(key) for key in keys]
+    images = decode_all(datas, skip=["age" in entry for entry in entries])
+    return AGE_PREDICTOR.predict_ages(images, cache=ANALYSIS_CACHE, keys=keys, service=AGE_SERVICE, entries=entries)
+
+
 # request handler for age estimation of a SINGLE image
 @app.route("/estimate_age", methods=["POST"])
 def estimate_age():
-    img = url2image(request.form.get("image_url"))
-    age, _, _ = AGE_PREDICTOR.predict_age(img)
+    age, _, _ = estimate_ages(fetch_all([request.form.get("image_url")]))[0]
     return json.dumps({"success": True, "age": age}), 200, {"ContentType": "application/json"}
 
 
@@ -60,41 +264,325 @@ def estimate_age():
 @app.route("/estimate_age_all", methods=["POST"])
 def estimate_age_all():
     unestimated = json.loads(request.form.get("unestimated"))
+    predictions = estimate_ages(fetch_all(list(map(lambda datum: datum["src"], unestimated))))
     results = []
-    for datum in unestimated:
-        img = url2image(datum["src"])
-        age, _, _ = AGE_PREDICTOR.predict_age(img)
+    for datum, (age, _, _) in zip(unestimated, predictions):
         results.append({"key": datum["key"], "age": age})
     return json.dumps({"success": True, "results": results}), 200, {"ContentType": "application/json"}
 
 
-# request handler for rendering a video and sending it back to JavaScript
-@app.route("/render_video", methods=["POST"])
-def render_video():
-    align = request.form.get("align")
-    mode = request.form.get("mode")
-    pause = float(request.form.get("pause"))
-    fps = int(request.form.get("fps"))
-    if mode == "cross-fading":
-        duration = float(request.form.get("duration"))
-    image_urls = list(map(lambda i: i["src"], json.loads(request.form.get("list"))))
-    images = list(map(lambda url: url2image(url), image_urls))
-    images, landmarks = VideoMaker.align_faces(images, mode=align)
-    if mode == "cross-fading":
-        VideoMaker.make_video(images, landmarks, "./data/out.mp4", interval=duration, pause=pause, fps=fps)
+# request handler for the queue depth and batch size statistics of the age model
+@app.route("/estimate_age_stats", methods=["GET"])
+def estimate_age_stats():
+    return json.dumps(dict(success=True, **AGE_SERVICE.stats())), 200, {"ContentType": "application/json"}
+
+
+# request handler for age estimation of multiple images, streamed back as results become available
+# takes the same form field as /estimate_age_all, and responds with one {"key", "age"} JSON object per line,
+# in the order in which the images finish rather than the order in which they were given
+@app.route("/estimate_age_all_stream", methods=["POST"])
+def estimate_age_all_stream():
+    unestimated = json.loads(request.form.get("unestimated"))
+    def estimate(datum):
+        age, _, _ = estimate_ages([url2bytes(datum["src"])])[0]
+        return {"key": datum["key"], "age": age}
+    def generate():
+        futures = [ESTIMATE_EXECUTOR.submit(estimate, datum) for datum in unestimated]
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + "\n"
+        finally:
+            # the client went away, don't bother with the rest
+            for future in futures:
+                future.cancel()
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+# request handler for age estimation of multiple images uploaded as binary files (see read_uploads)
+# the optional form field "keys" is a JSON list with the key of every image, by default the keys are the filenames
+@app.route("/estimate_age_all_upload", methods=["POST"])
+def estimate_age_all_upload():
+    uploads = read_uploads(request.files)
+    keys = json.loads(request.form["keys"]) if "keys" in request.form else [name for name, _ in uploads]
+    predictions = estimate_ages([data for _, data in uploads])
+    results = []
+    for key, (age, _, _) in zip(keys, predictions):
+        results.append({"key": key, "age": age})
+    return json.dumps({"success": True, "results": results}), 200, {"ContentType": "application/json"}
+
+
+# read the parameters of a render request from the submitted form
+# images are left as URLs, they are decoded by whoever performs the render
+# if uploads (see read_uploads) are given, the images are taken from them instead of the "list" field
+# the optional fields "width", "height", "crf" and "preset" set the size and quality of the video
+# the optional field "morph_engine" selects how morph frames are rendered, see video_maker.MORPH_ENGINES
+# "preview" set to "true" makes a quick, small, low quality render, capped at "preview_fps" frames per second
+def parse_render_form(form, uploads=None):
+    params = {
+        "align": form.get("align"),
+        "mode": form.get("mode"),
+        "pause": float(form.get("pause")),
+        "fps": int(form.get("fps")),
+    }
+    if uploads is None:
+        params["image_urls"] = list(map(lambda i: i["src"], json.loads(form.get("list"))))
     else:
-        VideoMaker.make_video_nomorph(images, "./data/out.mp4", pause=pause, fps=fps)
-    # convert video codec to h264
-    subprocess.run(["ffmpeg", "-i", "./data/out.mp4", "-vcodec", "h264", "./data/out_h264.mp4"])
+        params["image_datas"] = [data for _, data in uploads]
+    if params["mode"] == "cross-fading":
+        params["duration"] = float(form.get("duration"))
+    preview = form.get("preview") == "true"
+    if preview:
+        params["fps"] = min(params["fps"], int(form.get("preview_fps", 15)))
+    # h264 in yuv420p needs an even width and height
+    width = int(form.get("width", 400 if preview else 800))
+    height = int(form.get("height", 300 if preview else 600))
+    params["size"] = (width - width % 2, height - height % 2)
+    params["crf"] = int(form.get("crf", 32 if preview else 23))
+    params["preset"] = form.get("preset", "ultrafast" if preview else "veryfast")
+    params["morph_engine"] = form.get("morph_engine", "triangles" if preview else "field")
+    return params
+
+
+# render a video according to params (see parse_render_form) into out_filename
+# job, if given, is a RenderJob whose stage and frame counts are kept up to date
+def render(params, out_filename, job=None):
+    def set_stage(stage):
+        if job is not None:
+            job.update(stage=stage)
+    set_stage("decoding")
+    datas = params["image_datas"] if "image_datas" in params else fetch_all(params["image_urls"])
+    set_stage("aligning")
+    # faces are decoded, aligned and rendered one at a time, so memory use doesn't grow with the number of faces
+    # every pause and morph is encoded as a separate segment, segments from earlier renders are reused
+    executor = ALIGN_EXECUTOR.get() if len(datas) >= ALIGN_PARALLEL_MIN_FACES else None
+    aligned = VideoMaker.iter_aligned_faces(iter_decoded(datas), mode=params["align"], cache=ANALYSIS_CACHE,
+                                            keys=map(bytes2key, datas), detector=LANDMARK_DETECTORS,
+                                            executor=executor, size=params["size"])
+    def progress(frames_done, frames_total):
+        if job is not None:
+            job.update(stage="rendering", frames_done=frames_done, frames_total=frames_total)
+    VideoMaker.make_video_streaming(aligned, out_filename, SEGMENT_DIR, len(datas), interval=params.get("duration", 0),
+                                    pause=params["pause"], fps=params["fps"], morph=params["mode"] == "cross-fading",
+                                    workers=RENDER_WORKERS, encoder="ffmpeg", preset=params["preset"],
+                                    crf=params["crf"], progress=progress, max_cache_bytes=SEGMENT_CACHE_BYTES,
+                                    morph_engine=params["morph_engine"])
+    set_stage("done")
+
+
+# create a fresh temporary directory for a render, returned as an absolute path
+def make_workspace():
+    return tempfile.mkdtemp(prefix="render_", dir=os.path.abspath(RENDER_DIR))
+
+
+# remove the workspaces left behind in RENDER_DIR by earlier runs of the server, e.g. of jobs that were never fetched
+# only safe before any render has started
+def remove_workspaces():
+    if not os.path.isdir(RENDER_DIR):
+        return
+    for name in os.listdir(RENDER_DIR):
+        if name.startswith("render_") or name.startswith("job_"):
+            shutil.rmtree(os.path.join(RENDER_DIR, name), ignore_errors=True)
+
+
+# send a rendered mp4 back to JavaScript and remove its workspace once the file is open
+# if binary is True, the mp4 is sent as video/mp4 rather than disguised as text
+def send_video(workspace, binary=False):
+    mimetype = "video/mp4" if binary else "text/plain; charset=x-user-defined"
     # prepare response by sending the mp4
-    response = send_file("./data/out_h264.mp4", mimetype="text/plain; charset=x-user-defined", as_attachment=True)
-    # forcefully remove the "charset=utf-8" designation
-    response.headers["content-type"] = "text/plain; charset=x-user-defined"
+    response = send_file(os.path.join(workspace, "out_h264.mp4"), mimetype=mimetype, as_attachment=True)
+    if not binary:
+        # forcefully remove the "charset=utf-8" designation
+        response.headers["content-type"] = "text/plain; charset=x-user-defined"
     # clean up
-    subprocess.run(["rm", "./data/out.mp4", "./data/out_h264.mp4"])
+    shutil.rmtree(workspace, ignore_errors=True)
     return response
+
+
+# request handler for rendering a video and sending it back to JavaScript
+@app.route("/render_video", methods=["POST"])
+def render_video():
+    return render_and_send(parse_render_form(request.form))
+
+
+# request handler for rendering a video out of images uploaded as binary files (see read_uploads)
+# takes the same form fields as /render_video except "list", and sends back the video as video/mp4
+@app.route("/render_video_upload", methods=["POST"])
+def render_video_upload():
+    return render_and_send(parse_render_form(request.form, read_uploads(request.files)), binary=True)
+
+
+# render a video synchronously and send it back, see send_video
+def render_and_send(params, binary=False):
+    # every request renders in its own workspace so concurrent requests don't overwrite each other
+    workspace = make_workspace()
+    try:
+        render(params, os.path.join(workspace, "out_h264.mp4"))
+    except Exception:
+        shutil.rmtree(workspace, ignore_errors=True)
+        raise
+    return send_video(workspace, binary)
     # return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
 
+# a video render running in the background
+# stage is one of "queued", "decoding", "aligning", "rendering", "done", "failed"
+# everything about a job lives in its workspace (see job_workspace), its status in job.json and its video next to it,
+# so that any worker of a PreforkServer can report on it, not just the one that runs it
+class RenderJob:
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.workspace = job_workspace(self.id)
+        os.mkdir(self.workspace)
+        self.lock = threading.Lock()
+        self.stage = "queued"
+        self.frames_done = 0
+        self.frames_total = 0
+        self.error = None
+        # seconds spent in each stage of the pipeline, filled in once the job has finished
+        self.timings = None
+        # time.time() when the job finished, successfully or not
+        self.finished_at = None
+        self.saved_at = 0
+        self.save()
+
+    def update(self, **fields):
+        with self.lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            if "frames_done" not in fields or time.time() - self.saved_at >= RENDER_JOB_SAVE_INTERVAL:
+                self.save()
+
+    def status(self):
+        return {"job_id": self.id, "stage": self.stage, "frames_done": self.frames_done,
+                "frames_total": self.frames_total, "error": self.error, "timings": self.timings,
+                "finished_at": self.finished_at}
+
+    # write the status to job.json, readers never see a partly written file
+    def save(self):
+        self.saved_at = time.time()
+        path = os.path.join(self.workspace, "job.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.status(), f)
+        os.replace(path + ".tmp", path)
+
+    def run(self):
+        METRICS.start_request()
+        try:
+            render(self.params, os.path.join(self.workspace, "out_h264.mp4"), job=self)
+        except Exception as e:
+            self.update(stage="failed", error=str(e))
+            try:
+                os.remove(os.path.join(self.workspace, "out_h264.mp4"))
+            except FileNotFoundError:
+                pass
+        finally:
+            self.update(timings=METRICS.end_request(), finished_at=time.time())
+
+
+# the threads that run the render jobs of this process
+RENDER_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=RENDER_JOB_WORKERS)
+
+
+# the workspace of the render job with the given id, None if the id is malformed
+def job_workspace(job_id):
+    if re.fullmatch("[0-9a-f]{32}", job_id) is None:
+        return None
+    return os.path.join(os.path.abspath(RENDER_DIR), "job_" + job_id)
+
+
+# the last saved status of a render job (see RenderJob.status), None if there is no such job
+def load_job_status(job_id):
+    workspace = job_workspace(job_id)
+    if workspace is None:
+        return None
+    try:
+        with open(os.path.join(workspace, "job.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return None
+
+
+# forget the jobs that finished more than RENDER_JOB_TTL seconds ago and delete their workspaces
+def reap_render_jobs():
+    now = time.time()
+    for name in os.listdir(RENDER_DIR):
+        if not name.startswith("job_"):
+            continue
+        status = load_job_status(name[len("job_"):])
+        if status is not None and status["finished_at"] is not None and now - status["finished_at"] > RENDER_JOB_TTL:
+            shutil.rmtree(os.path.join(RENDER_DIR, name), ignore_errors=True)
+
+
+# request handler for submitting a video render, returns the id of the job right away
+@app.route("/render_jobs", methods=["POST"])
+def submit_render_job():
+    reap_render_jobs()
+    job = RenderJob(parse_render_form(request.form))
+    RENDER_JOB_EXECUTOR.submit(job.run)
+    return json.dumps({"success": True, "job_id": job.id}), 200, {"ContentType": "application/json"}
+
+
+# request handler for the progress of a render job
+@app.route("/render_jobs/<job_id>", methods=["GET"])
+def render_job_status(job_id):
+    status = load_job_status(job_id)
+    if status is None:
+        return json.dumps({"success": False}), 404, {"ContentType": "application/json"}
+    if status["stage"] == "failed" and status["finished_at"] is not None:
+        # the failure has been reported, forget about the job
+        shutil.rmtree(job_workspace(job_id), ignore_errors=True)
+    del status["finished_at"]
+    return json.dumps(dict(success=True, **status)), 200, {"ContentType": "application/json"}
+
+
+# request handler for the video of a finished render job, the job is forgotten once its video is sent
+@app.route("/render_jobs/<job_id>/result", methods=["GET"])
+def render_job_result(job_id):
+    status = load_job_status(job_id)
+    if status is None or status["stage"] != "done" or status["finished_at"] is None:
+        return json.dumps({"success": False}), 404, {"ContentType": "application/json"}
+    # only one request can move the workspace away, so the video is sent once even if it is asked for concurrently
+    workspace = os.path.join(os.path.abspath(RENDER_DIR), "render_" + job_id)
+    try:
+        os.rename(job_workspace(job_id), workspace)
+    except FileNotFoundError:
+        return json.dumps({"success": False}), 404, {"ContentType": "application/json"}
+    return send_video(workspace)
+
+
+# request handler for the metrics of this process in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8081, debug=True, threaded=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes forked after the models are loaded (default: run the "
+                             "single-process debug server)")
+    parser.add_argument("--threads", type=int, default=REQUEST_THREADS,
+                        help="maximum number of requests per worker process")
+    parser.add_argument("--no-metrics", action="store_true", help="turn off timing and counting for /metrics")
+    args = parser.parse_args()
+    METRICS.enabled = not args.no_metrics
+    remove_workspaces()
+    if args.workers > 0:
+        # models were loaded when this module was imported, the workers share them
+        LANDMARK_DETECTORS.resize(args.threads + RENDER_JOB_WORKERS)
+        # a scrape of /metrics lands on any one worker, which reports the sum over all of them and the parent
+        metrics_dir = os.path.join(RENDER_DIR, "metrics")
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        METRICS.share(metrics_dir, interval=None)
+
+        def init_worker():
+            # what the parent collected (e.g. the models it loaded) is in its own file
+            METRICS.reset()
+            METRICS.share(metrics_dir)
+
+        # a worker that is restarted or stopped finishes the render jobs it has started before it exits
+        PreforkServer(app, host="0.0.0.0", port=8081, workers=args.workers, threads=args.threads,
+                      init=init_worker, cleanup=lambda: RENDER_JOB_EXECUTOR.shutdown(wait=True)).serve_forever()
+    else:
+        app.run(host="0.0.0.0", port=8081, debug=True, threaded=True)
@@ -1,49 +1,102 @@
 import cv2
 import numpy as np
 from age_predictor import AgePredictor
+from concurrent.futures import ProcessPoolExecutor
 from os import walk
 
 
 class Sorter:
     # path specifies a directory that contains all the face images to be sorted
     # only accepts JPEG files!!
-    # these images will be read as numpy arrays and stored in a list
-    def __init__(self, path):
+    # only the paths of the images are kept, the images themselves are read when they are needed
+    # detection_size is the shorter side (in px) that images are at least downscaled to for face detection and age
+    # prediction, see imread_reduced
+    def __init__(self, path, detection_size=600):
         # each item in the list in an entry for an image:
         ## [path+filename, color_image, predicted_age, face_roi, face_roi_angle]
         ## path+filename: this is the unique path that identifies where the image is
-        ## color_image: the result of cv2.imread(path+filename)
+        ## color_image: always None here, list_all reads the full image at the time it is called
         ## predicted_age: a number that is returned by the age model
-        ## face_roi: a rectangular region of the image that contains the face
+        ## face_roi: a rectangular region of the (downscaled) image that contains the face
         ## face_roi_angle: face_roi rectangle might not be upright, so a rotation angle must be specified
         self.images = list()
-        # age predictor
-        self.ap = AgePredictor()
-        # walk the given path directory and read the images
-        # store all the images in the list
+        self.detection_size = detection_size
+        # age predictor, loaded by the first sort that needs it
+        self.ap = None
+        # walk the given path directory and list the images
         _, _, filenames = next(walk(path))
         filenames.sort()
         for f in filenames:
             if f[-5:] != ".jpeg": continue
-            self.images.append([path + f, cv2.imread(path + f), -1, None, 0])
+            self.images.append([path + f, None, -1, None, 0])
 
 
     # sorts the set of images based on age
     # this function assumes that the ages haven't been computed yet
     # should only call this function ONCE per Sorter!
-    def sort(self):
-        for image in self.images:
-            image[2], image[3], image[4] = self.ap.predict_age(image[1])
+    # images are read downscaled and run through the age predictor batch_size at a time, so only one batch is
+    # in memory at once
+    # workers is the number of processes that predict ages in parallel, each loads its own age predictor
+    # (1 predicts everything in this process)
+    def sort(self, workers=1, batch_size=32):
+        paths = [image[0] for image in self.images]
+        batches = [paths[start:start+batch_size] for start in range(0, len(paths), batch_size)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                predictions = executor.map(predict_batch_task, batches, [self.detection_size] * len(batches))
+                predictions = [prediction for batch in predictions for prediction in batch]
+        else:
+            if self.ap is None:
+                self.ap = AgePredictor(batch_size=batch_size)
+            predictions = [prediction for batch in batches
+                           for prediction in predict_batch(self.ap, batch, self.detection_size)]
+        for image, prediction in zip(self.images, predictions):
+            image[2], image[3], image[4] = prediction
         self.images.sort(key=lambda image: image[2])
 
 
     # list all entries, everything
+    # the images in the entries are read at full resolution by this call
     def list_all(self):
-        return self.images
+        return [[image[0], cv2.imread(image[0])] + image[2:] for image in self.images]
 
-    # list only the images (numpy arrays)
+    # list only the images (numpy arrays), read at full resolution by this call
     def list_all_images(self):
-        return list(map(lambda image: image[1], self.images))
+        return list(map(lambda image: cv2.imread(image[0]), self.images))
+
+
+# read the image at path at reduced resolution: the smallest of 1/8, 1/4, 1/2 and full size whose shorter side
+# is still at least min_side (or full size if none is)
+# JPEG decoding at 1/2, 1/4 and 1/8 scale skips most of the work, so this is much faster than reading the full image
+# the image is first read at 1/8 scale to find out its size, and read again only if that is too small
+def imread_reduced(path, min_side=600):
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        return None
+    full_side = min(img.shape[:2]) * 8
+    for factor, flag in ((8, None), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if full_side / factor >= min_side:
+            return img if flag is None else cv2.imread(path, flag)
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+# read the images at paths downscaled (see imread_reduced) and predict their ages with the AgePredictor ap
+# returns a list of (apparent_age, roi, angle) tuples, same as AgePredictor.predict_ages
+# the ROIs are copied out of the images (crop_face returns a view), so that the images can be freed right away
+def predict_batch(ap, paths, min_side):
+    predictions = ap.predict_ages([imread_reduced(path, min_side) for path in paths])
+    return [(age, None if roi is None else roi.copy(), angle) for age, roi, angle in predictions]
+
+
+# per-process state for predict_batch_task: the age predictor, loaded the first time it is needed
+_sort_state = {}
+
+
+# predict_batch for Sorter.sort, runs in a worker process
+def predict_batch_task(paths, min_side):
+    if "ap" not in _sort_state:
+        _sort_state["ap"] = AgePredictor()
+    return predict_batch(_sort_state["ap"], paths, min_side)
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,38 @@
+import numpy as np
+import cv2
+from scipy.spatial import Delaunay
+
+
+# dense warp field of the piecewise affine warp over a triangulation of control points, for ImageWarper
+# every triangle of dst_points (an (n, 2) array of (x, y)) is mapped onto the triangle with the same vertices in
+# src_points by a single affine transformation, and the field holds, for every pixel of an image of the given
+# (height, width), the offset from the pixel to where that transformation takes it
+# a fraction of the field is the piecewise affine warp towards the same fraction of the way from dst_points to
+# src_points, so it only has to be computed once for all frames of a morph
+# the points should cover the whole image, e.g. include its corners, the field is 0 outside of all triangles
+# returns (x, y) as float32 arrays
+def affine_fields(dst_points, src_points, size):
+    dst_points = np.asarray(dst_points, dtype=np.float64)
+    src_points = np.asarray(src_points, dtype=np.float64)
+    triangles = Delaunay(dst_points).simplices
+    # the affine transformation of every triangle, from its destination pixels to its source pixels,
+    # minus the identity, as a (3, 2) matrix that multiplies (x, y, 1)
+    inverses = np.linalg.inv(np.concatenate((dst_points[triangles], np.ones(triangles.shape + (1,))), axis=2))
+    offsets = np.einsum("nij,njk->nik", inverses, src_points[triangles])
+    offsets[:, :2] -= np.eye(2)
+    # the index of the triangle of every pixel, with an extra triangle of no offset for the pixels outside of all
+    labels = np.full(size, len(triangles), dtype=np.int32)
+    for i, triangle in enumerate(triangles):
+        cv2.fillConvexPoly(labels, np.rint(dst_points[triangle]).astype(np.int32), i)
+    offsets = np.concatenate((offsets, np.zeros((1, 3, 2)))).astype(np.float32)[labels]
+    grid_y, grid_x = np.mgrid[0:size[0], 0:size[1]].astype(np.float32)
+    x = offsets[..., 0, 0] * grid_x + offsets[..., 1, 0] * grid_y + offsets[..., 2, 0]
+    y = offsets[..., 0, 1] * grid_x + offsets[..., 1, 1] * grid_y + offsets[..., 2, 1]
+    return x, y
+
+
+# control points that pin the border of an image of the given (height, width) in place:
+# its corners and the midpoints of its edges, as (x, y)
+def border_anchors(size):
+    h, w = size[0] - 1, size[1] - 1
+    return np.array([[0, 0], [w / 2, 0], [w, 0], [0, h / 2], [w, h / 2], [0, h], [w / 2, h], [w, h]])
@@ -1,11 +1,61 @@
 import numpy as np
 import cv2
 import math
+import time
+import subprocess
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from sorter import Sorter
-from detect_landmarks import FaceLandmarkDetector
+from detect_landmarks import FaceLandmarkDetector, FaceLandmarkDetectorPool
 from warp_image import ImageWarper
-from face_detector import rotate_image
+from triangle_warp import affine_fields, border_anchors
+from face_detector import rotate_image, transform_landmarks
 import extrapolate_vector_field as evf
+from analysis_cache import AnalysisCache
+from metrics import METRICS
+
+
+# pool of worker processes for align_faces and make_video
+# workers are forked, possibly while another thread has an FFmpegWriter open, see close_inherited_encoders
+# (a fork server or spawned workers would import the __main__ module again in every worker, which for the server
+# means loading all of its models)
+def worker_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+# FFmpegWriters that are open in this process, and a lock that keeps processes from forking while one is being opened
+_open_encoders = weakref.WeakSet()
+_open_encoders_lock = threading.RLock()
+
+
+# runs in every process forked from this one, e.g. the workers of a worker_pool
+# a process forked while an FFmpegWriter is open inherits the write end of its stdin, and ffmpeg only sees the end of
+# its input once every copy is closed, so a long-lived worker would block the release of the encoder forever
+# the copies are pointed at /dev/null rather than closed, so nothing in the child can write into ffmpeg or into
+# whatever reuses the descriptor, and a descriptor is only touched if it is still the pipe of its encoder
+def close_inherited_encoders():
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    for writer in list(_open_encoders):
+        try:
+            stat = os.fstat(writer.fd)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) == writer.pipe:
+            os.dup2(devnull, writer.fd)
+    os.close(devnull)
+    _open_encoders_lock.release()
+
+
+os.register_at_fork(before=_open_encoders_lock.acquire, after_in_parent=_open_encoders_lock.release,
+                    after_in_child=close_inherited_encoders)
 
 
 # given a list of face images already sorted according to age 
@@ -16,30 +66,202 @@ import extrapolate_vector_field as evf
 ### translation, so that the eyes are aligned in all images
 ## mode "eye" uses eye alignment all the way
 ## mode "lse" uses least square alignment for all images except the first
-def align_faces(faces, mode="eye"):
+# if an AnalysisCache is given, landmarks are looked up there before running the landmark detector,
+# and the landmarks that had to be detected are added to the cache
+# keys are the cache keys of the faces, by default the hash of their pixels
+# redetect selects whether landmarks of the aligned faces are detected again, see eye_alignment
+# detector is the FaceLandmarkDetector (or FaceAnalyzer) to use, or a FaceLandmarkDetectorPool to borrow one from
+# by default a new FaceLandmarkDetector is loaded
+# workers is the number of processes that align faces in parallel (1 aligns everything in this process),
+# alternatively executor is an existing pool (see worker_pool) to use, whose workers keep their detectors loaded
+# size is the (width, height) of the aligned faces, the alignment targets scale along with it (see scale_targets)
+def align_faces(faces, mode="eye", cache=None, keys=None, redetect=False, detector=None, workers=1, executor=None,
+                size=(800, 600)):
     results = []
     landmarks = []
-    d = FaceLandmarkDetector()
-    if mode == "eye":
-        for img in faces:
-            img_aligned, new_landmarks = eye_alignment(img, d)
-            if img_aligned is None or new_landmarks.shape == (0, 2):
-                continue
-            results.append(img_aligned)
-            landmarks.append(new_landmarks)
-    elif mode == "lse":
+    for img_aligned, new_landmarks in iter_aligned_faces(faces, mode, cache, keys, redetect, detector, workers,
+                                                         executor, size):
+        results.append(img_aligned)
+        landmarks.append(new_landmarks)
+    return results, landmarks
+
+
+# generator version of align_faces, yields (aligned face, landmarks) for one face at a time, in order
+# faces can be any iterable, e.g. a generator that decodes the images as they are needed,
+# so that only a few faces are ever in memory no matter how many there are
+# keys, if given, is an iterable of cache keys parallel to faces
+# window is the maximum number of faces handed to worker processes ahead of the one being yielded
+def iter_aligned_faces(faces, mode="eye", cache=None, keys=None, redetect=False, detector=None, workers=1,
+                       executor=None, size=(800, 600), window=None):
+    if mode not in ("eye", "lse"):
+        return
+    if keys is None:
+        faces = ((img, AnalysisCache.key(img) if cache is not None else None) for img in faces)
+    else:
+        faces = zip(faces, keys)
+    if executor is not None or workers > 1:
+        yield from iter_aligned_faces_parallel(faces, mode, cache, redetect, detector, workers, executor, size, window)
+        return
+    # the detector is only borrowed for the alignment of each face, not while the caller uses the aligned face
+    if detector is None:
+        detector = FaceLandmarkDetector()
+    prev_landmarks = None
+    for img, key in faces:
+        with borrow_detector(detector) as d:
+            img_aligned, new_landmarks = align_face(img, d, mode, prev_landmarks, cache, key, redetect, size=size)
+        if img_aligned is None or new_landmarks.shape == (0, 2):
+            continue
+        if mode == "lse":
+            prev_landmarks = new_landmarks
+        yield img_aligned, new_landmarks
+
+
+# same as iter_aligned_faces, but the per-face work is done by a pool of worker processes
+# mode "eye" aligns every face in a worker
+# mode "lse" detects landmarks and scales every face in a worker, only the least square fit to the previous face
+# (which depends on the result for the previous face) is done here, in order
+# faces is an iterable of (image, cache key) pairs
+# at most window faces (by default twice the number of CPUs) are in the workers at any time
+def iter_aligned_faces_parallel(faces, mode, cache, redetect, detector, workers, executor=None, size=(800, 600),
+                                window=None):
+    if window is None:
+        window = 2 * max(workers, os.cpu_count() or 1)
+    alignment = alignment_key("eye", size)
+    if detector is None and mode == "lse" and redetect:
+        detector = FaceLandmarkDetector()
+    # each pending face is (image, key, its cache entry, cached aligned landmarks for mode "eye", future)
+    pending = deque()
+    with nullcontext(executor) if executor is not None else worker_pool(workers) as executor:
         prev_landmarks = None
-        for img in faces:
-            if prev_landmarks is None:
-                img_aligned, new_landmarks = eye_alignment(img, d)
+        while True:
+            for img, key in itertools.islice(faces, window - len(pending)):
+                entry = {} if cache is None else cache.get(key)
+                if mode == "eye":
+                    aligned_landmarks = entry.get("aligned", {}).get(alignment) if redetect else None
+                    future = executor.submit(eye_alignment_task, img, entry.get("landmarks"), aligned_landmarks,
+                                             redetect, size)
+                else:
+                    aligned_landmarks = None
+                    future = executor.submit(scale_face_task, img, entry.get("landmarks"), size)
+                pending.append((img, key, entry, aligned_landmarks, future))
+            if len(pending) == 0:
+                return
+            img, key, entry, aligned_landmarks, future = pending.popleft()
+            # the work done by the workers shows up as the time spent waiting for it
+            with METRICS.timer("align_wait"):
+                face_landmarks, result = future.result()
+            # add the landmarks detected by the worker to the cache
+            if cache is not None and "landmarks" not in entry:
+                cache.update(key, landmarks=face_landmarks)
+            if mode == "eye":
+                img_aligned, new_landmarks = result
+                if img_aligned is None or new_landmarks.shape == (0, 2):
+                    continue
+                if cache is not None and redetect and aligned_landmarks is None:
+                    cache.update(key, aligned={alignment: new_landmarks})
             else:
-                img_aligned, new_landmarks = least_square_alignment(prev_landmarks, img, d)
-            if img_aligned is None or new_landmarks.shape == (0, 2):
-                continue
-            prev_landmarks = new_landmarks
-            results.append(img_aligned)
-            landmarks.append(new_landmarks)
-    return results, landmarks
+                # a detector is only needed here to detect the landmarks of aligned faces again
+                with borrow_detector(detector) if redetect else nullcontext() as d:
+                    img_aligned, new_landmarks = align_face(img, d, "lse", prev_landmarks, cache, key, redetect,
+                                                            landmarks=face_landmarks, scaled=result, size=size,
+                                                            entry=entry)
+                if img_aligned is None or new_landmarks.shape == (0, 2):
+                    continue
+                prev_landmarks = new_landmarks
+            yield img_aligned, new_landmarks
+
+
+# yield the landmark detector to use for DETECTOR as given to align_faces
+@contextmanager
+def borrow_detector(detector):
+    if isinstance(detector, FaceLandmarkDetectorPool):
+        with detector.checkout() as d:
+            yield d
+    elif detector is not None:
+        yield detector
+    else:
+        yield FaceLandmarkDetector()
+
+
+# per-process state for the alignment tasks: the landmark detector, loaded the first time it is needed
+_align_state = {}
+
+
+def worker_detector():
+    if "d" not in _align_state:
+        _align_state["d"] = FaceLandmarkDetector()
+    return _align_state["d"]
+
+
+# eye alignment of a single face, runs in a worker process
+# returns the landmarks of IMG and the result of eye_alignment
+def eye_alignment_task(img, landmarks, aligned_landmarks, redetect, size):
+    if landmarks is None:
+        landmarks = worker_detector().predict(img)
+    d = worker_detector() if redetect and aligned_landmarks is None else None
+    return landmarks, eye_alignment(img, d, landmarks=landmarks, aligned_landmarks=aligned_landmarks, redetect=redetect,
+                                    size=size)
+
+
+# first step of least square alignment of a single face, runs in a worker process
+# returns the landmarks of IMG and the result of scale_face, or None if no landmarks were found
+def scale_face_task(img, landmarks, size):
+    if landmarks is None:
+        landmarks = worker_detector().predict(img)
+    if landmarks.shape == (0, 2):
+        return landmarks, None
+    ed, _, _ = scale_targets(size)
+    return landmarks, scale_face(img, landmarks, ed)
+
+
+# align a single face IMG for align_faces, consulting the cache entry for KEY if a cache is given
+# the landmarks of the original image are cached under "landmarks", unless they are given
+# when redetect is True, the detected landmarks of the aligned image are cached under "aligned", see alignment_key
+# otherwise they are mapped from the landmarks of the original image, which is cheap enough not to cache
+# scaled is the result of scale_face for IMG, if already known, and entry its cache entry, if already looked up
+def align_face(img, d, mode, prev_landmarks, cache=None, key=None, redetect=False, landmarks=None, scaled=None,
+               size=(800, 600), entry=None):
+    if entry is None:
+        entry = {} if cache is None else cache.get(key)
+    if landmarks is None:
+        landmarks = entry.get("landmarks")
+    if landmarks is None:
+        landmarks = d.predict(img)
+        if cache is not None:
+            cache.update(key, landmarks=landmarks)
+    if mode == "eye" or prev_landmarks is None:
+        alignment = alignment_key("eye", size)
+        aligned_landmarks = entry.get("aligned", {}).get(alignment) if redetect else None
+        with METRICS.timer("align"):
+            img_aligned, new_landmarks = eye_alignment(img, d, landmarks=landmarks, aligned_landmarks=aligned_landmarks,
+                                                       redetect=redetect, size=size)
+    else:
+        alignment = alignment_key("lse", size, prev_landmarks)
+        aligned_landmarks = entry.get("aligned", {}).get(alignment) if redetect else None
+        with METRICS.timer("align"):
+            img_aligned, new_landmarks = least_square_alignment(prev_landmarks, img, d, landmarks=landmarks,
+                                                                aligned_landmarks=aligned_landmarks, redetect=redetect,
+                                                                scaled=scaled, size=size)
+    if cache is not None and redetect and aligned_landmarks is None and new_landmarks is not None:
+        cache.update(key, aligned={alignment: new_landmarks})
+    return img_aligned, new_landmarks
+
+
+# key of the landmarks of an aligned face in the "aligned" field of its cache entry
+# the aligned landmarks depend on the alignment mode and size, and for "lse" also on the previous face
+def alignment_key(mode, size, prev_landmarks=None):
+    key = mode + ":" + str(size[0]) + "x" + str(size[1])
+    if prev_landmarks is not None:
+        key += ":" + AnalysisCache.key(prev_landmarks)
+    return key
+
+
+# the alignment targets below are given for 800*600 faces
+# scale them for faces of the given (width, height), returns the scaled (ed, el, et)
+def scale_targets(size, ed=150, el=400, et=260):
+    sx = size[0] / 800
+    sy = size[1] / 600
+    return ed * min(sx, sy), el * sx, et * sy
 
 
 # given a single face IMG, do transformations on it
@@ -53,10 +275,18 @@ def align_faces(faces, mode="eye"):
 ### ed: the desired eye distance (in px) after scaling (default to 150)
 ### el: the left margin (in px) after translation (default to 400)
 ### et: the top margin (in px) after translation (default to 260)
-def eye_alignment(img, d, ed=150, el=400, et=260):
+### landmarks: landmarks of IMG if already known, otherwise they are detected with d
+### aligned_landmarks: landmarks of the result if already known
+### redetect: if True, the landmarks of the result are detected with d (for verification),
+###           otherwise the landmarks of IMG are mapped through the same transformation as the image
+### size: (width, height) of the result, ed, el and et are scaled along with it (default to 800*600)
+def eye_alignment(img, d, ed=150, el=400, et=260, landmarks=None, aligned_landmarks=None, redetect=False,
+                  size=(800, 600)):
     cc = img.shape[2] # number of channels
+    ed, el, et = scale_targets(size, ed, el, et)
     # step 1: rotate the image (without downsizing it) to make the eyes horizontal
-    landmarks = d.predict(img)
+    if landmarks is None:
+        landmarks = d.predict(img)
     if landmarks.shape == (0, 2):
         return None, None # landmarks not detected in this face, skip it
     eye1 = landmarks[36]
@@ -67,7 +297,7 @@ def eye_alignment(img, d, ed=150, el=400, et=260):
     eye_dist = np.linalg.norm(eye1 - eye2)
     sf = ed / eye_dist
     img_rs = cv2.resize(img_r, None, fx=sf, fy=sf)
-    # step 3: crop out/pad a 800*600 region with the eyes at the center
+    # step 3: crop out/pad a region of the given size with the eyes at the center
     oldY, oldX = img.shape[:2]
     newY, newX = img_r.shape[:2]
     Mr = cv2.getRotationMatrix2D(center=(oldX/2, oldY/2), angle=angle * 180 / np.pi, scale=1)
@@ -77,19 +307,23 @@ def eye_alignment(img, d, ed=150, el=400, et=260):
     eye_center = 0.5 * (eye1rs + eye2rs)
     ex = int(eye_center[0])
     ey = int(eye_center[1])
-    minx = ex - el
-    maxx = minx + 800
-    miny = ey - et
-    maxy = miny + 600
+    minx = int(ex - el)
+    maxx = minx + size[0]
+    miny = int(ey - et)
+    maxy = miny + size[1]
     dy, dx = img_rs.shape[:2]
     hh = min(maxy, dy) - max(miny, 0)
     ww = min(maxx, dx) - max(minx, 0)
     hs = max(-miny, 0)
     ws = max(-minx, 0)
-    result = np.full((600, 800, cc), (0,0,0), dtype=np.uint8)
+    result = np.full((size[1], size[0], cc), (0,0,0), dtype=np.uint8)
     result[hs:hs+hh, ws:ws+ww] = img_rs[max(miny, 0):min(maxy, dy), max(minx, 0):min(maxx, dx)]
-    landmarks = d.predict(result)
-    return result, landmarks
+    if aligned_landmarks is None and redetect:
+        aligned_landmarks = d.predict(result)
+    elif aligned_landmarks is None:
+        aligned_landmarks = transform_landmarks(transform_landmarks(landmarks, Mr), Mt) * sf - (minx, miny)
+        aligned_landmarks = np.rint(aligned_landmarks).astype("int")
+    return result, aligned_landmarks
 
 
 # given the transformed version of the previous face in the sequence
@@ -102,18 +336,24 @@ def eye_alignment(img, d, ed=150, el=400, et=260):
 ### img: face IMG of the current face
 ### d: reference to a face landmark detector object
 ### ed: the desired eye distance (in px) for the purpose of scaling (default to 150)
-def least_square_alignment(prev_landmarks, img, d, ed=150):
+### landmarks: landmarks of IMG if already known, otherwise they are detected with d
+### aligned_landmarks: landmarks of the result if already known
+### redetect: if True, the landmarks of the result are detected with d (for verification),
+###           otherwise the landmarks of IMG are mapped through the same transformation as the image
+### scaled: the result of scale_face(img, landmarks, ed) if already known
+### size: (width, height) of the result, ed is scaled along with it (default to 800*600)
+def least_square_alignment(prev_landmarks, img, d, ed=150, landmarks=None, aligned_landmarks=None, redetect=False,
+                           scaled=None, size=(800, 600)):
     cc = img.shape[2] # number of channels
+    ed, _, _ = scale_targets(size, ed)
     # step 1: detect eyes, and scale the image so that the eyes have desired distance
-    landmarks = d.predict(img).astype(np.float32)
+    if landmarks is None:
+        landmarks = d.predict(img)
     if landmarks.shape == (0, 2):
         return None, None # landmarks not detected in this face, skip it
-    eye1 = landmarks[36]
-    eye2 = landmarks[45]
-    eye_dist = np.linalg.norm(eye1 - eye2)
-    sf = ed / eye_dist
-    img_s = cv2.resize(img, None, fx=sf, fy=sf)
-    landmarks *= sf
+    if scaled is None:
+        scaled = scale_face(img, landmarks, ed)
+    img_s, landmarks = scaled
     # step 2: compute optimal rotation/translation using Kabsch's Algorithm
     A_centroid = np.mean(landmarks, axis=0)
     B_centroid = np.mean(prev_landmarks, axis=0)
@@ -129,21 +369,37 @@ def least_square_alignment(prev_landmarks, img, d, ed=150):
     (oldY, oldX) = img_s.shape[:2]
     img_sr, M = rotate_image(img_s, scaleFactor=1, degreesCCW=theta * 180 / np.pi)
     A_centroid = np.matmul(M, np.append(A_centroid, 1))
-    # step 5: crop out 800*600 region in the roto-scaled image
+    # step 5: crop out a region of the given size in the roto-scaled image
     # must make sure that after cropping A_centroid overlaps with B_centroid!!
     minx = int(A_centroid[0] - B_centroid[0])
-    maxx = minx + 800
+    maxx = minx + size[0]
     miny = int(A_centroid[1] - B_centroid[1])
-    maxy = miny + 600
+    maxy = miny + size[1]
     dy, dx = img_sr.shape[:2]
     hh = min(maxy, dy) - max(miny, 0)
     ww = min(maxx, dx) - max(minx, 0)
     hs = max(-miny, 0)
     ws = max(-minx, 0)
-    result = np.full((600, 800, cc), (0,0,0), dtype=np.uint8)
+    result = np.full((size[1], size[0], cc), (0,0,0), dtype=np.uint8)
     result[hs:hs+hh, ws:ws+ww] = img_sr[max(miny, 0):min(maxy, dy), max(minx, 0):min(maxx, dx)]
-    landmarks = d.predict(result)
-    return result, landmarks
+    if aligned_landmarks is None and redetect:
+        aligned_landmarks = d.predict(result)
+    elif aligned_landmarks is None:
+        aligned_landmarks = np.rint(transform_landmarks(landmarks, M) - (minx, miny)).astype("int")
+    return result, aligned_landmarks
+
+
+# step 1 of least_square_alignment: scale IMG so that the two eyes have distance ed (in px)
+# returns the scaled image and the scaled landmarks
+def scale_face(img, landmarks, ed=150):
+    landmarks = landmarks.astype(np.float32)
+    eye1 = landmarks[36]
+    eye2 = landmarks[45]
+    eye_dist = np.linalg.norm(eye1 - eye2)
+    sf = ed / eye_dist
+    img_s = cv2.resize(img, None, fx=sf, fy=sf)
+    landmarks *= sf
+    return img_s, landmarks
 
 
 # given a list of transformed faces
@@ -152,53 +408,559 @@ def least_square_alignment(prev_landmarks, img, d, ed=150):
 # interval is the time (in seconds) between each successive face
 # pause is the time (in seconds) that we dwell on each face
 # fps is the frame rate of the video
-def make_video(faces, landmarks, out_filename, interval=1, pause=0.5, fps=30):
+# workers is the number of processes that render morph frames (1 renders everything in this process)
+# chunk_size is the number of consecutive morph frames a worker renders per task
+# window is the maximum number of tasks in flight, which caps the number of rendered frames waiting to be written
+# encoder, preset and crf select how the frames are encoded, see open_writer
+# progress, if given, is called as progress(frames_done, frames_total) after every frame written
+# morph_engine selects how the morph frames are rendered, see MORPH_ENGINES
+# with encoder "ffmpeg" every pause is encoded only once, see write_held_video
+def make_video(faces, landmarks, out_filename, interval=1, pause=0.5, fps=30, workers=1, chunk_size=10, window=None,
+               encoder="opencv", preset="veryfast", crf=23, progress=None, morph_engine="field"):
     assert len(faces) > 1
-    e = evf.Extrapolator()
-    w = ImageWarper()
-    out = cv2.VideoWriter(out_filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (800,600))
-    for i in range(len(faces) - 1):
-        face1 = faces[i]
-        face2 = faces[i+1]
-        landmarks1 = landmarks[i]
-        landmarks2 = landmarks[i+1]
+    # the pauses are left to write_held_video when encoding with ffmpeg
+    frames_pause = 0 if encoder == "ffmpeg" else pause
+    if workers > 1:
+        frames = morph_frames_parallel(faces, landmarks, interval, frames_pause, fps, workers, chunk_size, window,
+                                       morph_engine)
+    else:
+        frames = morph_frames(faces, landmarks, interval, frames_pause, fps, morph_engine)
+    if encoder == "ffmpeg":
+        write_held_video(faces, frames, int(interval * fps), out_filename, pause, fps, preset, crf, progress)
+        return
+    # cv2.VideoWriter only writes constant frame rate videos, so a pause is written as copies of the face
+    out = open_writer(out_filename, fps, frame_size(faces), encoder, preset, crf)
+    frames_total = (len(faces) - 1) * (int(pause * fps) + int(interval * fps)) + int(pause * fps)
+    write_frames(out, frames, frames_total, progress)
+    out.release()
+
+
+# compute the warping fields face1 -> face2 and face2 -> face1 from the landmarks of both faces
+# out_size is the (height, width) of the faces
+# returns (face1_fx, face1_fy, face2_fx, face2_fy) as float32 arrays
+def morph_fields(e, landmarks1, landmarks2, out_size=(600,800)):
+    with METRICS.timer("extrapolate"):
         # compute the warping field face1 -> face2
         face1_x = landmarks2[:, 0]
         face1_y = landmarks2[:, 1]
         face1_dx = landmarks1[:, 0] - landmarks2[:, 0]
         face1_dy = landmarks1[:, 1] - landmarks2[:, 1]
-        face1_fx, face1_fy = e.extrapolate(face1_x, face1_y, face1_dx, face1_dy, (600,800))
+        face1_fx, face1_fy = e.extrapolate(face1_x, face1_y, face1_dx, face1_dy, out_size)
         # compute the warping field face2 -> face1
         face2_x = landmarks1[:, 0]
         face2_y = landmarks1[:, 1]
         face2_dx = landmarks2[:, 0] - landmarks1[:, 0]
         face2_dy = landmarks2[:, 1] - landmarks1[:, 1]
-        face2_fx, face2_fy = e.extrapolate(face2_x, face2_y, face2_dx, face2_dy, (600,800))
+        face2_fx, face2_fy = e.extrapolate(face2_x, face2_y, face2_dx, face2_dy, out_size)
+    return tuple(f.astype(np.float32) for f in (face1_fx, face1_fy, face2_fx, face2_fy))
+
+
+# compute the piecewise affine warping fields face1 -> face2 and face2 -> face1 from the landmarks of both faces
+# this is the piecewise affine counterpart of morph_fields: the fields of morph_fields are linear over the triangles
+# of the landmarks of the target face, so warping each such triangle with a single affine transformation gives the
+# same result, except near the border, which is pinned by a few anchors here rather than by every border pixel
+# out_size is the (height, width) of the faces
+# returns (face1_fx, face1_fy, face2_fx, face2_fy) as float32 arrays, like morph_fields
+def morph_affine_fields(landmarks1, landmarks2, out_size=(600,800)):
+    anchors = border_anchors(out_size)
+    points1 = np.concatenate((landmarks1, anchors))
+    points2 = np.concatenate((landmarks2, anchors))
+    return affine_fields(points2, points1, out_size) + affine_fields(points1, points2, out_size)
+
+
+# ways to render the frames between two faces, selected by the morph_engine argument of make_video
+# each one has prepare(landmarks1, landmarks2, out_size), which does the work that is shared by all frames of a pair,
+# and blend(face1, face2, prepared, warp_amount), which renders one frame into a buffer owned by the engine
+## "field" warps with dense warp fields, see morph_fields
+## "triangles" warps every triangle of the landmarks with its own affine transformation, see morph_affine_fields,
+##            whose fields take a small fraction of the time to compute; frames are rendered the same way
+class FieldMorph:
+    def __init__(self):
+        self.e = evf.Extrapolator()
+        self.w = ImageWarper()
+
+    def prepare(self, landmarks1, landmarks2, out_size):
+        return morph_fields(self.e, landmarks1, landmarks2, out_size)
+
+    def blend(self, face1, face2, prepared, warp_amount):
+        face1_fx, face1_fy, face2_fx, face2_fy = prepared
+        return self.w.blend(face1, face1_fx, face1_fy, face2, face2_fx, face2_fy, warp_amount)
+
+
+class TriangleMorph:
+    def __init__(self):
+        self.w = ImageWarper()
+
+    def prepare(self, landmarks1, landmarks2, out_size):
+        with METRICS.timer("triangulate"):
+            return morph_affine_fields(landmarks1, landmarks2, out_size)
+
+    def blend(self, face1, face2, prepared, warp_amount):
+        face1_fx, face1_fy, face2_fx, face2_fy = prepared
+        return self.w.blend(face1, face1_fx, face1_fy, face2, face2_fx, face2_fy, warp_amount)
+
+
+MORPH_ENGINES = {"field": FieldMorph, "triangles": TriangleMorph}
+
+
+# generator for all the frames of the morphing video, in order, rendered in this process
+# morph frames are a buffer that is reused for the whole video, so they are only valid until the next frame
+def morph_frames(faces, landmarks, interval, pause, fps, morph_engine="field"):
+    engine = MORPH_ENGINES[morph_engine]()
+    warp_amounts = np.linspace(0., 1., int(interval * fps))
+    for i in range(len(faces) - 1):
+        face1 = faces[i]
+        face2 = faces[i+1]
+        prepared = engine.prepare(landmarks[i], landmarks[i+1], face1.shape[:2])
         # first put original face1 into the video for duration "pause"
         for j in range(int(pause * fps)):
-            out.write(face1)
+            yield face1
         # then produce the warped sequence
-        warp_amounts = np.linspace(0., 1., int(interval * fps))
-        for j, warp_amount in enumerate(warp_amounts):
-            face1_warped = w.warp(face1, face1_fx, face1_fy, warp_amount)
-            face2_warped = w.warp(face2, face2_fx, face2_fy, 1 - warp_amount)
-            # We alpha blend the original images
-            face_out = (1 - warp_amount) * face1_warped + warp_amount * face2_warped
-            # write video frame
-            out.write(face_out.astype(np.uint8))
+        for warp_amount in warp_amounts:
+            # warp both faces and alpha blend them into a frame buffer that is reused for the whole video
+            yield engine.blend(face1, face2, prepared, warp_amount)
     # put the last face into the video for duration "pause"
     for i in range(int(pause * fps)):
-        out.write(faces[-1])
-    out.release()
+        yield faces[-1]
+
+
+# same as morph_frames, but the morph frames are rendered by a pool of worker processes, see MorphRenderer
+# executor, if given, is an existing pool (see worker_pool) to use instead of starting one
+def morph_frames_parallel(faces, landmarks, interval, pause, fps, workers, chunk_size=10, window=None,
+                          morph_engine="field", executor=None):
+    with (nullcontext(executor) if executor is not None else worker_pool(workers)) as executor:
+        renderer = MorphRenderer(executor, workers, np.linspace(0., 1., int(interval * fps)), morph_engine, chunk_size,
+                                 window)
+        for i in range(len(faces) - 1):
+            renderer.add(faces[i], faces[i+1], landmarks[i], landmarks[i+1])
+        for i in range(len(faces) - 1):
+            # first put original face1 into the video for duration "pause"
+            for j in range(int(pause * fps)):
+                yield faces[i]
+            for frame in renderer.frames():
+                yield frame
+    # put the last face into the video for duration "pause"
+    for i in range(int(pause * fps)):
+        yield faces[-1]
+
+
+# renders the morph frames of a sequence of transitions on a pool of worker processes (see worker_pool)
+# transitions are added ahead of time (see add) and their frames are taken one transition at a time, in the same order
+# the work shared by all frames of a transition (see MORPH_ENGINES) is prepared once, by a worker, and shipped along
+# with every task of the transition; preparations run up to `workers` transitions ahead of the tasks
+# every transition is split into tasks of chunk_size frames, and tasks are handed out in order
+# at most window tasks are in flight at any time, results are consumed strictly in order
+class MorphRenderer:
+    def __init__(self, executor, workers, warp_amounts, morph_engine="field", chunk_size=10, window=None):
+        self.executor = executor
+        self.workers = workers
+        self.warp_amounts = warp_amounts
+        self.morph_engine = morph_engine
+        self.chunk_size = chunk_size
+        self.window = 2 * workers if window is None else window
+        # transitions that still have tasks to hand out, as [face1, face2, landmarks1, landmarks2, future of the
+        # prepared work or None], and the first warp amount of the next task of the first of them
+        self.transitions = deque()
+        self.next_amount = 0
+        # futures of the tasks in flight, in order
+        self.pending = deque()
+
+    # queue the transition face1 -> face2
+    def add(self, face1, face2, landmarks1, landmarks2):
+        if len(self.warp_amounts) > 0:
+            self.transitions.append([face1, face2, landmarks1, landmarks2, None])
+            self.fill()
+
+    # start preparing the next transitions and keep the reorder window full
+    def fill(self):
+        while True:
+            for transition in itertools.islice(self.transitions, self.workers):
+                if transition[4] is None:
+                    transition[4] = self.executor.submit(prepare_task, transition[2], transition[3],
+                                                         transition[0].shape[:2], self.morph_engine)
+            if len(self.transitions) == 0 or len(self.pending) >= self.window:
+                return
+            face1, face2, _, _, prepared = self.transitions[0]
+            # a task can only be handed out once its transition is prepared,
+            # until then the frames of the tasks in flight are consumed
+            if not prepared.done() and len(self.pending) > 0:
+                return
+            amounts = self.warp_amounts[self.next_amount:self.next_amount + self.chunk_size]
+            self.pending.append(self.executor.submit(render_chunk, face1, face2, prepared.result(), amounts,
+                                                     self.morph_engine))
+            self.next_amount += self.chunk_size
+            if self.next_amount >= len(self.warp_amounts):
+                # all tasks of the transition have been handed out, its prepared work isn't needed anymore
+                self.transitions.popleft()
+                self.next_amount = 0
+
+    # generator for the morph frames of the first transition whose frames haven't been taken yet
+    def frames(self):
+        for start in range(0, len(self.warp_amounts), self.chunk_size):
+            self.fill()
+            for frame in self.pending.popleft().result():
+                yield frame
+
+
+# per-process state for the morph tasks: the morph engines, created the first time they are needed
+_render_state = {}
+
+
+def worker_engine(morph_engine):
+    if morph_engine not in _render_state:
+        _render_state[morph_engine] = MORPH_ENGINES[morph_engine]()
+    return _render_state[morph_engine]
+
+
+# prepare a transition from landmarks1 to landmarks2 for render_chunk, runs in a worker process
+def prepare_task(landmarks1, landmarks2, out_size, morph_engine="field"):
+    return worker_engine(morph_engine).prepare(landmarks1, landmarks2, out_size)
+
+
+# render the morph frames face1 -> face2 for the given warp amounts, runs in a worker process
+# prepared is the result of prepare_task for the two faces
+def render_chunk(face1, face2, prepared, warp_amounts, morph_engine="field"):
+    engine = worker_engine(morph_engine)
+    return [engine.blend(face1, face2, prepared, warp_amount).copy() for warp_amount in warp_amounts]
 
 
 # a much simpler version of the video maker that doesn't perform the morphing operations
-def make_video_nomorph(faces, out_filename, pause=1, fps=30):
-    out = cv2.VideoWriter(out_filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (800,600))
-    for i in range(len(faces)):
-        for j in range(int(pause * fps)):
-            out.write(faces[i])
+# with encoder "ffmpeg" every face is encoded only once, see write_held_video
+def make_video_nomorph(faces, out_filename, pause=1, fps=30, encoder="opencv", preset="veryfast", crf=23, progress=None):
+    if encoder == "ffmpeg":
+        write_held_video(faces, iter(()), 0, out_filename, pause, fps, preset, crf, progress)
+        return
+    out = open_writer(out_filename, fps, frame_size(faces), encoder, preset, crf)
+    frames = (faces[i] for i in range(len(faces)) for j in range(int(pause * fps)))
+    write_frames(out, frames, len(faces) * int(pause * fps), progress)
+    out.release()
+
+
+# encode every face held still for pause, with the morph frames between successive faces, into out_filename
+# frames is an iterator over the morph frames of all transitions in order, morph_frame_count frames per transition
+# each pause is encoded once as a hold clip (see encode_hold) and each transition as a clip of its own, and the clips
+# are joined by stream copy, so the video looks and lasts the same as one with every pause written frame by frame
+# progress, if given, is called as progress(frames_done, frames_total), counting the frames of the pauses as shown
+def write_held_video(faces, frames, morph_frame_count, out_filename, pause, fps, preset="veryfast", crf=23,
+                     progress=None):
+    pause_frames = int(pause * fps)
+    frames_total = len(faces) * pause_frames + (len(faces) - 1) * morph_frame_count
+    frames_done = 0
+    segments = []
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_filename))) as tmp:
+        for i, face in enumerate(faces):
+            if i > 0 and morph_frame_count > 0:
+                path = os.path.join(tmp, "%d-morph.mp4" % i)
+                out = FFmpegWriter(path, fps, frame_size(faces), preset=preset, crf=crf)
+                offset = frames_done
+                write_frames(out, itertools.islice(frames, morph_frame_count), frames_total,
+                             None if progress is None else lambda done, total: progress(offset + done, total))
+                out.release()
+                segments.append((path, morph_frame_count))
+                frames_done += morph_frame_count
+            if pause_frames > 0:
+                path = os.path.join(tmp, "%d-hold.mp4" % i)
+                encode_hold(face, pause_frames, fps, path, preset, crf)
+                segments.append((path, pause_frames))
+                frames_done += pause_frames
+                if progress is not None:
+                    progress(frames_done, frames_total)
+        # let the frames generator finish, which shuts down the worker pool of morph_frames_parallel
+        next(frames, None)
+        concat_segments(segments, out_filename, fps)
+
+
+# encode face held still for n frames at fps into out_filename, as h264 with variable frame rate timestamps
+# only the first frame and a copy timed as the last one are encoded, which shows the same as n copies of the face
+# for a fraction of the encoding work
+def encode_hold(face, n, fps, out_filename, preset="veryfast", crf=23):
+    out = FFmpegWriter(out_filename, fps, frame_size([face]), preset=preset, crf=crf,
+                       setpts="N*%d/(FRAME_RATE*TB)" % (n - 1))
+    write_frames(out, [face] * min(n, 2), n)
+    out.release()
+
+
+# (width, height) of the video for the given faces, all faces must have the same size
+def frame_size(faces):
+    return faces[0].shape[1], faces[0].shape[0]
+
+
+# write all frames to the video writer, reporting progress(frames_done, frames_total) if given
+# the time spent producing the frames is recorded as the stage "render", the time spent writing them as "encode"
+def write_frames(out, frames, frames_total, progress=None):
+    render_seconds = 0
+    encode_seconds = 0
+    frames_done = 0
+    frames = iter(frames)
+    while True:
+        start = time.perf_counter()
+        frame = next(frames, None)
+        written = time.perf_counter()
+        render_seconds += written - start
+        if frame is None:
+            break
+        out.write(frame)
+        encode_seconds += time.perf_counter() - written
+        frames_done += 1
+        if progress is not None:
+            progress(frames_done, frames_total)
+    METRICS.record("render", render_seconds)
+    METRICS.record("encode", encode_seconds)
+    METRICS.inc("frames_written_total", frames_done)
+
+
+# same video as make_video (or make_video_nomorph if morph is False), but every pause and every morph between
+# two faces is encoded as a separate segment, and the segments are joined by stream copy into out_filename
+# segments are kept in segment_dir, named after a hash of everything that goes into them (the aligned faces,
+# their landmarks, number of frames, fps, morph engine and encoder settings), so a render after a small edit only
+# encodes the segments that the edit touched; the least recently used segments are removed once segment_dir exceeds
+# max_cache_bytes
+def make_video_incremental(faces, landmarks, out_filename, segment_dir, interval=1, pause=0.5, fps=30, morph=True,
+                           workers=1, encoder="ffmpeg", preset="veryfast", crf=23, progress=None,
+                           max_cache_bytes=2 * 1024 * 1024 * 1024, morph_engine="field"):
+    make_video_streaming(zip(faces, landmarks), out_filename, segment_dir, len(faces), interval, pause, fps, morph,
+                         workers, encoder, preset, crf, progress, max_cache_bytes, morph_engine)
+
+
+# same as make_video_incremental, but the faces come from an iterable of (face, landmarks) pairs, e.g. the generator
+# returned by iter_aligned_faces, and only the current and the previous face are ever held in memory
+# count is the expected number of faces, which is only used for progress; if some faces turn out to be missing
+# the total goes down once the last face has been rendered
+def make_video_streaming(aligned, out_filename, segment_dir, count, interval=1, pause=0.5, fps=30, morph=True,
+                         workers=1, encoder="ffmpeg", preset="veryfast", crf=23, progress=None,
+                         max_cache_bytes=2 * 1024 * 1024 * 1024, morph_engine="field"):
+    os.makedirs(segment_dir, exist_ok=True)
+    pause_frames = int(pause * fps)
+    morph_frame_count = int(interval * fps) if morph else 0
+    frames_total = count * pause_frames + max(count - 1, 0) * morph_frame_count
+    frames_done = 0
+    paths = []
+    links = []
+
+    # each segment is (number of frames, faces in it, their landmarks)
+    def segments():
+        prev = None
+        for face, face_landmarks in aligned:
+            if prev is not None and morph_frame_count > 0:
+                yield morph_frame_count, [prev[0], face], [prev[1], face_landmarks]
+            if pause_frames > 0:
+                yield pause_frames, [face], [face_landmarks]
+            prev = (face, face_landmarks)
+
+    # encode the segment unless it was cached, and add it to the video
+    def finish(path, n, segment_faces, segment_landmarks, cached):
+        nonlocal frames_done
+        if not cached:
+            frames = renderer.frames() if renderer is not None and len(segment_faces) > 1 else None
+            write_segment(path, segment_faces, segment_landmarks, n, interval, fps, workers, encoder, preset, crf,
+                          morph_engine, executor, frames)
+        link = os.path.join(tmp, "%d.mp4" % len(links))
+        while not link_segment(path, link):
+            path = encode_segment(segment_dir, segment_faces, segment_landmarks, n, interval, fps, workers, encoder,
+                                  preset, crf, morph_engine, executor)
+        paths.append(path)
+        links.append((link, n))
+        frames_done += n
+        if progress is not None:
+            progress(frames_done, max(frames_total, frames_done))
+
+    # every segment is linked into a directory of this render as soon as it is encoded or found, so that a concurrent
+    # render that prunes segment_dir (maybe in another process) can't remove it before it is joined
+    # the morph segments of a render share one pool of workers: the segments are looked up 2 * workers ahead of the
+    # one being encoded, and the morphs that aren't cached are queued on a MorphRenderer right away, so that their
+    # preparations and frames are rendered while the segments before them are encoded
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_filename))) as tmp, \
+         (worker_pool(workers) if workers > 1 and morph else nullcontext()) as executor:
+        renderer = None
+        if executor is not None:
+            renderer = MorphRenderer(executor, workers, np.linspace(0., 1., morph_frame_count), morph_engine)
+        upcoming = deque()
+        for n, segment_faces, segment_landmarks in segments():
+            path = segment_path(segment_dir, segment_faces, segment_landmarks, n, fps, encoder, preset, crf,
+                                morph_engine)
+            cached = segment_cached(path)
+            if not cached and renderer is not None and len(segment_faces) > 1:
+                renderer.add(segment_faces[0], segment_faces[1], segment_landmarks[0], segment_landmarks[1])
+            upcoming.append((path, n, segment_faces, segment_landmarks, cached))
+            if len(upcoming) > 2 * workers:
+                finish(*upcoming.popleft())
+        while len(upcoming) > 0:
+            finish(*upcoming.popleft())
+        if progress is not None:
+            progress(frames_done, frames_done)
+        concat_segments(links, out_filename, fps)
+    prune_segments(segment_dir, max_cache_bytes, keep=paths)
+
+
+# make link a hard link to the segment at path, or a copy of it if path is on another file system
+# returns False if the segment has been removed in the meantime, e.g. by prune_segments
+def link_segment(path, link):
+    try:
+        os.link(path, link)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            shutil.copyfile(path, link)
+        except FileNotFoundError:
+            return False
+    return True
+
+
+# encode a segment of n frames into segment_dir unless it is already there, returns its path
+# a segment of a single face holds it still, a segment of two faces morphs the first into the second
+def encode_segment(segment_dir, faces, landmarks, n, interval, fps, workers, encoder, preset, crf,
+                   morph_engine="field", executor=None):
+    path = segment_path(segment_dir, faces, landmarks, n, fps, encoder, preset, crf, morph_engine)
+    if not segment_cached(path):
+        write_segment(path, faces, landmarks, n, interval, fps, workers, encoder, preset, crf, morph_engine, executor)
+    return path
+
+
+# version of the way segments are encoded, part of their cache key so that segments cached by an older version
+# aren't reused
+SEGMENT_VERSION = 2
+
+
+# where the segment of n frames of the given faces is cached in segment_dir, see encode_segment
+def segment_path(segment_dir, faces, landmarks, n, fps, encoder, preset, crf, morph_engine="field"):
+    key = hashlib.sha1(repr((SEGMENT_VERSION, n, fps, faces[0].shape, encoder, preset, crf)).encode())
+    # a pause doesn't depend on the landmarks or the morph engine, only a morph does
+    if len(faces) > 1:
+        key.update(morph_engine.encode())
+    for face, face_landmarks in zip(faces, landmarks):
+        key.update(np.ascontiguousarray(face).data)
+        if len(faces) > 1:
+            key.update(np.ascontiguousarray(face_landmarks).data)
+    return os.path.abspath(os.path.join(segment_dir, key.hexdigest() + ".mp4"))
+
+
+# whether the segment at path has been encoded already, a cached segment is marked as recently used
+def segment_cached(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        METRICS.inc("segment_cache_misses_total")
+        return False
+    METRICS.inc("segment_cache_hits_total")
+    return True
+
+
+# encode a segment (see encode_segment) to path
+# with encoder "ffmpeg" a hold is encoded once, see encode_hold
+# frames, if given, are the frames of a morph, e.g. from a MorphRenderer, otherwise they are rendered here:
+# by executor, if given, the pool (see worker_pool) that renders a morph when workers > 1
+def write_segment(path, faces, landmarks, n, interval, fps, workers, encoder, preset, crf, morph_engine="field",
+                  executor=None, frames=None):
+    # encode into a temporary file first so that an interrupted render never leaves a partial segment
+    # renders run in threads and in processes that share segment_dir, and may encode the same segment at the same time
+    tmp_path = path[:-len(".mp4")] + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp.mp4"
+    if len(faces) == 1 and encoder == "ffmpeg":
+        encode_hold(faces[0], n, fps, tmp_path, preset, crf)
+        os.replace(tmp_path, path)
+        return
+    if frames is None and len(faces) == 1:
+        frames = (faces[0] for j in range(n))
+    elif frames is None and workers > 1:
+        frames = morph_frames_parallel(faces, landmarks, interval, 0, fps, workers, morph_engine=morph_engine,
+                                       executor=executor)
+    elif frames is None:
+        frames = morph_frames(faces, landmarks, interval, 0, fps, morph_engine)
+    out = open_writer(tmp_path, fps, frame_size(faces), encoder, preset, crf)
+    write_frames(out, frames, n)
     out.release()
+    os.replace(tmp_path, path)
+
+
+# join video segments with identical encoding into out_filename without re-encoding them
+# segments are (path, number of frames) pairs, every segment starts n / fps after the previous one: the container
+# duration of a hold clip ends at its last frame, so it can't be relied on for where the next segment starts
+def concat_segments(segments, out_filename, fps):
+    list_filename = out_filename + ".segments.txt"
+    with open(list_filename, "w") as f:
+        for path, n in segments:
+            f.write("file '" + path.replace("'", "'\\''") + "'\n")
+            f.write("duration %.6f\n" % (n / fps))
+    try:
+        with METRICS.timer("concat"):
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_filename,
+                            "-c", "copy", out_filename], check=True)
+    finally:
+        os.remove(list_filename)
+
+
+# remove the least recently used segments until segment_dir is at most max_bytes, never removing the ones in keep
+# segments that other renders are still encoding are left alone, unless they were abandoned more than
+# stale_seconds ago; segments that other renders are about to join are safe too, see make_video_streaming
+def prune_segments(segment_dir, max_bytes, keep=(), stale_seconds=3600):
+    keep = set(keep)
+    entries = []
+    for name in os.listdir(segment_dir):
+        path = os.path.abspath(os.path.join(segment_dir, name))
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if name.endswith(".tmp.mp4") and stat.st_mtime > time.time() - stale_seconds:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# open a video writer for frames of the given size (width, height)
+## encoder "opencv" writes an mp4v video with cv2.VideoWriter
+## encoder "ffmpeg" pipes the raw frames into an ffmpeg process that encodes them with h264 directly
+### preset and crf are the x264 speed preset and quality (lower crf is better quality), only used by "ffmpeg"
+def open_writer(out_filename, fps, size, encoder="opencv", preset="veryfast", crf=23):
+    if encoder == "opencv":
+        return cv2.VideoWriter(out_filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    elif encoder == "ffmpeg":
+        return FFmpegWriter(out_filename, fps, size, preset=preset, crf=crf)
+    raise ValueError("unknown encoder: " + str(encoder))
+
+
+# drop-in replacement for cv2.VideoWriter that streams BGR frames into ffmpeg over stdin
+# the output is h264 in yuv420p, which browsers can play without another transcode
+# setpts, if given, is an ffmpeg setpts expression that retimes the frames, which are then muxed with their own
+# timestamps instead of one every 1 / fps, and without an edit list: the edit list of a variable frame rate mp4 ends
+# at the timestamp of the last frame, which would drop the last frame
+class FFmpegWriter:
+    def __init__(self, out_filename, fps, size, preset="veryfast", crf=23, setpts=None):
+        self.out_filename = out_filename
+        retime = [] if setpts is None else ["-vf", "setpts=" + setpts, "-vsync", "passthrough", "-use_editlist", "0"]
+        # a process forked before the encoder is registered would keep its stdin open, see close_inherited_encoders
+        with _open_encoders_lock:
+            self.proc = subprocess.Popen([
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "%dx%d" % size, "-r", str(fps), "-i", "-"] + retime + [
+                "-an", "-vcodec", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p",
+                out_filename], stdin=subprocess.PIPE)
+            self.fd = self.proc.stdin.fileno()
+            stat = os.fstat(self.fd)
+            self.pipe = (stat.st_dev, stat.st_ino)
+            _open_encoders.add(self)
+
+    def write(self, frame):
+        self.proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        # ffmpeg is still encoding the frames it has buffered
+        with METRICS.timer("encode"):
+            self.proc.stdin.close()
+            _open_encoders.discard(self)
+            code = self.proc.wait()
+        if code != 0:
+            raise RuntimeError("ffmpeg failed to encode " + self.out_filename)
 
 
 # if __name__ == "__main__":
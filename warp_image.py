@@ -7,23 +7,52 @@ class ImageWarper:
     """Warp image using a dense warp field"""
 
     def __init__(self):
-        return
+        # identity grids, remap maps and output frames are allocated once per image size and reused on every call
+        self.grids = {}
+        self.maps = {}
+        self.buffers = {}
 
-    def warp(self, img, x, y, warp_amount=1):
+    def warp(self, img, x, y, warp_amount=1, dst=None):
         # img_warped should be a warped version of img
         # x and y are the warp field in the x and y direction
         # warp amount, if specified, is multiplied by the warp field. So, e.g., warp_amount=0.5 will produce less warping
-        img_size = img.shape
-        rangex = img_size[1]
-        rangey = img_size[0]
-        map_y, map_x = np.mgrid[0:rangey, 0:rangex].astype(np.float32)
-        map_x += warp_amount * x
-        map_y += warp_amount * y
+        # dst, if specified, is a preallocated array the warped image is written into
+        map_x, map_y = self.build_maps(x, y, warp_amount, img.shape[:2])
 
-        img_warped = cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR)
+        img_warped = cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, dst=dst)
 
         return img_warped
 
+    def blend(self, img1, x1, y1, img2, x2, y2, warp_amount):
+        # warp img1 by warp_amount of its warp field and img2 by (1 - warp_amount) of its warp field
+        # then alpha blend the two, weighting img2 by warp_amount
+        # the returned frame is a buffer owned by this ImageWarper, it is overwritten by the next call to blend
+        img1_warped = self.warp(img1, x1, y1, warp_amount, dst=self.get_buffer(img1.shape, "img1"))
+        img2_warped = self.warp(img2, x2, y2, 1 - warp_amount, dst=self.get_buffer(img2.shape, "img2"))
+        frame = self.get_buffer(img1.shape, "frame")
+        cv2.addWeighted(img1_warped, 1 - warp_amount, img2_warped, warp_amount, 0, dst=frame)
+        return frame
+
+    # fill the reusable float32 maps with identity grid + warp_amount * warp field, without temporaries
+    def build_maps(self, x, y, warp_amount, size):
+        if size not in self.grids:
+            grid_y, grid_x = np.mgrid[0:size[0], 0:size[1]].astype(np.float32)
+            self.grids[size] = (grid_x, grid_y)
+            self.maps[size] = (np.empty_like(grid_x), np.empty_like(grid_y))
+        grid_x, grid_y = self.grids[size]
+        map_x, map_y = self.maps[size]
+        np.multiply(x, warp_amount, out=map_x)
+        np.multiply(y, warp_amount, out=map_y)
+        map_x += grid_x
+        map_y += grid_y
+        return map_x, map_y
+
+    def get_buffer(self, shape, name):
+        key = (shape, name)
+        if key not in self.buffers:
+            self.buffers[key] = np.empty(shape, dtype=np.uint8)
+        return self.buffers[key]
+
 
 # if __name__ == "__main__":
 #     # Input filename